@@ -3,11 +3,25 @@
 import os
 import sys
 import stat
+import re
+import hashlib
+import json
 from optparse import OptionParser
 import subprocess
+import tempfile
+import time
 from collections import OrderedDict
 import datetime
 
+# Counters of /proc/PID/io (characters read and written, including pipes and page cache) summed over the processes of a stage
+IO_COUNTERS = ['rchar', 'wchar']
+
+# Memory page size in kilobytes
+PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+
+# Number of processes option of the tools (CoverView, CAVA), left out of stage checksums as it does not change the results
+THREADS_OPTION = re.compile(r' -t \d+\b')
+
 #################################################################################################################
 
 # Read configuration file
@@ -39,19 +53,20 @@ def readConfigFile(scriptdir, fn):
 # Check command line options
 def checkOptions(options):
 
-    # Input fastq files
-    if options.fastq is None: sys.exit('\nInput files not specified.\n')
-    x = options.fastq.split(',')
-    if not len(x) == 2: sys.exit('\nIncorrect format for option --input.\n')
-    if not x[0].endswith('.fastq.gz') or not x[1].endswith('.fastq.gz'): sys.exit('\nInput files must have .fastq.gz format.\n')
-    if os.path.isfile(x[0]): x[0] = os.path.abspath(x[0])
-    else: sys.exit('Input file  %s does not exist.' % x[0])
-    if os.path.isfile(x[1]): x[1] = os.path.abspath(x[1])
-    else: sys.exit('Input file  %s does not exist.' % x[1])
-    options.fastq = x[0]+','+x[1]
+    # Sample sheet (replacing input fastq files and output files prefix)
+    if options.samples is not None:
+        if os.path.isfile(options.samples): options.samples = os.path.abspath(options.samples)
+        else: sys.exit('Sample sheet %s does not exist.' % options.samples)
+    else:
+
+        # Input fastq files
+        if options.fastq is None: sys.exit('\nInput files not specified.\n')
+        x = options.fastq.split(',')
+        if not len(x) == 2: sys.exit('\nIncorrect format for option --input.\n')
+        options.fastq = ','.join(checkFastqFiles(x))
 
-    # Output files prefix
-    if options.name is None: sys.exit('\nOutput files prefix not specified.\n')
+        # Output files prefix
+        if options.name is None: sys.exit('\nOutput files prefix not specified.\n')
 
     # Bed file
     if options.bed is not None:
@@ -70,30 +85,426 @@ def checkOptions(options):
     except:
         sys.exit('Value of option --threads should be positive integer')
 
+    # Memory (total memory of the machine by default)
+    if options.memory is None: options.memory = readTotalMemory()
+    if options.memory is not None:
+        try:
+            mi = int(options.memory)
+            if not mi > 0: raise
+        except:
+            sys.exit('Value of option --memory should be positive integer')
+
     return options
 
+# Read total memory (Gb, rounded down) from /proc/meminfo (None if not available)
+def readTotalMemory():
+    if not os.path.isfile('/proc/meminfo'): return None
+    for line in open('/proc/meminfo'):
+        x = line.split()
+        if len(x) >= 2 and x[0] == 'MemTotal:': return max(1, int(x[1]) / (1024 * 1024))
+    return None
+
+# Check input fastq files and convert to absolute path
+def checkFastqFiles(x):
+    if not x[0].endswith('.fastq.gz') or not x[1].endswith('.fastq.gz'): sys.exit('\nInput files must have .fastq.gz format.\n')
+    if os.path.isfile(x[0]): x[0] = os.path.abspath(x[0])
+    else: sys.exit('Input file  %s does not exist.' % x[0])
+    if os.path.isfile(x[1]): x[1] = os.path.abspath(x[1])
+    else: sys.exit('Input file  %s does not exist.' % x[1])
+    return x
+
+# Read sample sheet (tab separated sample name, fastq.gz file 1 and fastq.gz file 2 in each line)
+def readSampleSheet(fn):
+    ret = []
+    names = set()
+    for line in open(fn):
+        line = line.strip()
+        if line.startswith('#') or line == '': continue
+        cols = line.split('\t')
+        if not len(cols) == 3: sys.exit('\nIncorrect format for line of sample sheet: %s\n' % line)
+        name = cols[0].strip()
+        if name in names: sys.exit('Sample name %s is not unique in sample sheet.' % name)
+        names.add(name)
+        fastq1, fastq2 = checkFastqFiles([cols[1].strip(), cols[2].strip()])
+        ret.append(Sample(name, fastq1, fastq2))
+    if len(ret) == 0: sys.exit('\nNo samples specified in sample sheet.\n')
+    return ret
+
+# Read chromosome names and lengths (in reference genome order) from the .fai index of the reference genome
+def readChromLengths(reference):
+    ret = []
+    if not os.path.isfile(reference + '.fai'): return ret
+    for line in open(reference + '.fai'):
+        cols = line.split('\t')
+        if len(cols) >= 2: ret.append((cols[0], int(cols[1])))
+    return ret
+
+# Read targets of bed file as sorted, merged (0-based, half-open) intervals of each chromosome
+def readBedIntervals(fn):
+    ret = dict()
+    for line in open(fn):
+        if line.startswith('#') or line.startswith('track') or line.startswith('browser'): continue
+        cols = line.rstrip('\n').split('\t')
+        if len(cols) < 3: continue
+        ret.setdefault(cols[0], []).append((int(cols[1]), int(cols[2])))
+    for chrom in ret:
+        merged = []
+        for start, end in sorted(ret[chrom]):
+            if len(merged) > 0 and start <= merged[-1][1]: merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else: merged.append((start, end))
+        ret[chrom] = merged
+    return ret
+
+# Split the genome into at most n disjoint shards of Platypus regions (chrom or chrom:start-end, 1-based) in reference
+# genome order, balancing the genome length or, if targets are given, the target bases of the shards. Shards break
+# between chromosomes and, if targets are given, in the middle of gaps between targets (without targets, a cut within a
+# chromosome could split the window of an indel between two shards)
+def makeShards(chromlengths, targets, n):
+
+    # Pieces (chrom, start, end, weight) that are not broken up
+    pieces = []
+    for chrom, length in chromlengths:
+        intervals = [] if targets is None else targets.get(chrom, [])
+        if targets is None: pieces.append((chrom, 1, length, length))
+        elif len(intervals) == 0: pieces.append((chrom, 1, length, 0))
+        else:
+            start = 1
+            for i in range(len(intervals)):
+                if i == len(intervals) - 1: end = length
+                else: end = (intervals[i][1] + 1 + intervals[i + 1][0]) / 2
+                pieces.append((chrom, start, end, intervals[i][1] - intervals[i][0]))
+                start = end + 1
+
+    # Assigning consecutive pieces to shards, merging pieces of the same chromosome into one region
+    total = sum(piece[3] for piece in pieces)
+    if targets is not None and total == 0: return makeShards(chromlengths, None, n)
+    shards = [[]]
+    acc = 0
+    for chrom, start, end, weight in pieces:
+        if len(shards) < n and len(shards[-1]) > 0 and acc >= total * len(shards) / float(n): shards.append([])
+        if len(shards[-1]) > 0 and shards[-1][-1][0] == chrom: shards[-1][-1][2] = end
+        else: shards[-1].append([chrom, start, end])
+        acc += weight
+
+    lengths = dict(chromlengths)
+    return [[chrom if start == 1 and end == lengths[chrom] else chrom + ':' + str(start) + '-' + str(end) for chrom, start, end in shard] for shard in shards]
+
+# Repeat #@scatter stages of the template for each shard, and expand other words containing @SHARD to the words of all shards
+def expandShards(lines, shards):
+    sections = [[]]
+    for line in lines:
+        if line.startswith('#@stage'): sections.append([])
+        sections[-1].append(line)
+
+    ret = []
+    for section in sections:
+        if any(line.startswith('#@scatter') for line in section):
+            for i in range(len(shards)):
+                info = ' (shard ' + str(i + 1) + ' of ' + str(len(shards)) + ')' if len(shards) > 1 else ''
+                regions = '--regions=' + ','.join(shards[i]) if len(shards) > 1 else ''
+                for line in section:
+                    ret.append(line.replace('@SHARDINFO', info).replace('@REGIONS', regions).replace('@SHARD', str(i + 1)))
+        else:
+            for line in section:
+                if '@SHARD' in line:
+                    words = []
+                    for word in line.split():
+                        if '@SHARD' in word: words.extend([word.replace('@SHARD', str(i + 1)) for i in range(len(shards))])
+                        else: words.append(word)
+                    line = ' '.join(words) + '\n'
+                ret.append(line)
+    return ret
+
 # Generate script based on template
-def generateFile(params, fnin, fnout):
+def generateFile(params, fnin, fnout, shards):
+    with open(fnin, "rt") as fin:
+        lines = expandShards(fin.readlines(), shards)
     with open(fnout, "wt") as fout:
-        with open(fnin, "rt") as fin:
-            for line in fin:
-                for key, value in params.iteritems():
-                    line = line.replace('@' + key, value)
-                fout.write(line)
+        for line in lines:
+            for key, value in params.iteritems():
+                line = line.replace('@' + key, value)
+            fout.write(line)
 
 # Make script executable
 def makeExecutable(fn):
     st = os.stat(fn)
     os.chmod(fn, st.st_mode | stat.S_IEXEC)
 
-# Execute script
-def executeScript(cmd_str):
-    cmd = cmd_str.split()
-    popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    for stdout_line in iter(popen.stdout.readline, ""): yield stdout_line.strip()
-    popen.stdout.close()
-    return_code = popen.wait()
-    if return_code: raise subprocess.CalledProcessError(return_code, cmd)
+# Class representing a sample processed by the pipeline
+class Sample(object):
+    # Constructor
+    def __init__(self, name, fastq1, fastq2):
+        self.name = name
+        self.fastq1 = fastq1
+        self.fastq2 = fastq2
+        self.label = ''
+        self.logf = None
+        self.checkpointfn = name + '_opex_checkpoints.txt'
+        self.metricsfn = name + '_opex_metrics.json'
+        self.stages = []
+        self.checkpoints = dict()
+        self.terminated = False
+
+# Class representing a stage (#@stage section) of the pipeline script of a sample
+class Stage(object):
+    # Constructor
+    def __init__(self, name, sample, preamble):
+        self.name = name
+        self.sample = sample
+        self.preamble = preamble
+        self.lines = []
+        self.inputs = []
+        self.outputs = []
+        self.threads = 1
+        self.memory = 1
+        self.io = False
+        self.message = None
+        self.dependencies = []
+        self.checksum = None
+        self.process = None
+        self.outf = None
+        self.status = 'not run'
+        self.starttime = None
+        self.endtime = None
+        self.rusage = None
+        self.peakrss = 0
+        self.iocounters = dict.fromkeys(IO_COUNTERS, 0)
+
+    # Add line of the script to the stage
+    def addLine(self, line):
+        x = line.split()
+        if line.startswith('#@outputs'): self.outputs.extend(x[1:])
+        elif line.startswith('#@threads'): self.threads = int(x[1])
+        elif line.startswith('#@memory'): self.memory = int(x[1])
+        elif line.startswith('#@io'): self.io = True
+        elif len(x) > 0 and x[0] == 'checkFiles': self.inputs.extend(x[1:])
+        elif len(x) > 0 and x[0] == 'msg' and self.message is None: self.message = line.strip()[4:].strip('"')
+        self.lines.append(line)
+
+    # Check if input files of the stage exist
+    def missingInputs(self):
+        return [fn for fn in self.inputs if not os.path.exists(fn)]
+
+    # Check if output files of the stage exist
+    def outputsExist(self):
+        return all(os.path.exists(fn) for fn in self.outputs)
+
+    # Calculate checksum of the stage from its script lines (commands, parameters and tool versions), the checksums of
+    # the stages creating its inputs, and the size and modification time of its input files (including the ones created
+    # by other stages, so that the stage is re-run when they are re-created) and of the files (e.g. configuration files)
+    # referred to in its commands. The numbers of processes used (#@threads and -t options) are left out, so that
+    # resuming with a different --threads does not re-run stages whose results do not depend on it
+    def calculateChecksum(self, paramfiles):
+        text = ''.join(self.lines)
+        h = hashlib.md5(''.join(THREADS_OPTION.sub('', line) for line in self.lines if not line.startswith('#@threads')))
+        for dep in self.dependencies: h.update(dep.name + ':' + dep.checksum + '\n')
+        for fn in self.inputs + [fn for fn in paramfiles if fn in text]: h.update(fileSignature(fn) + '\n')
+        self.checksum = h.hexdigest()
+
+    # Check if the stage has been completed by a previous run with the same checksum
+    def upToDate(self):
+        return self.sample.checkpoints.get(self.name) == self.checksum and self.outputsExist()
+
+    # Start running the stage in the background, capturing its stdout
+    def start(self):
+        self.outf = tempfile.TemporaryFile()
+        self.starttime = time.time()
+        self.process = subprocess.Popen(['bash', '-c', self.preamble + ''.join(self.lines)], stdout=self.outf, stderr=subprocess.STDOUT)
+        self.status = 'running'
+
+    # Sample total resident memory and I/O counters of the processes of the running stage (bash process and its
+    # descendants). Counters of finished processes are included in those of the processes that waited for them
+    def sampleUsage(self, children):
+        pids = [self.process.pid]
+        i = 0
+        while i < len(pids):
+            pids.extend(children.get(pids[i], []))
+            i += 1
+        rss = 0
+        io = dict.fromkeys(IO_COUNTERS, 0)
+        for pid in pids:
+            try:
+                rss += int(open('/proc/%d/statm' % pid).read().split()[1]) * PAGE_SIZE_KB
+                for line in open('/proc/%d/io' % pid):
+                    key, value = line.split(':')
+                    if key in io: io[key] += int(value)
+            except (IOError, ValueError):
+                continue
+        self.peakrss = max(self.peakrss, rss)
+        for key in IO_COUNTERS: self.iocounters[key] = max(self.iocounters[key], io[key])
+
+    # Check if the stage has finished, collecting its resource usage (including that of its descendants) if it has
+    def finished(self):
+        pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0: return False
+        self.process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        self.endtime = time.time()
+        self.rusage = rusage
+        return True
+
+    # Resource usage and timing of the stage
+    def metrics(self):
+        ret = OrderedDict()
+        ret['stage'] = self.name
+        ret['status'] = self.status
+        ret['threads'] = self.threads
+        ret['memory_gb'] = self.memory
+        if self.rusage is None: return ret
+        ret['exit_code'] = self.process.returncode
+        ret['start'] = datetime.datetime.fromtimestamp(self.starttime).strftime("%Y-%m-%d %H:%M:%S")
+        ret['wall_time_s'] = round(self.endtime - self.starttime, 2)
+        ret['user_time_s'] = round(self.rusage.ru_utime, 2)
+        ret['system_time_s'] = round(self.rusage.ru_stime, 2)
+        ret['cpu_time_s'] = round(self.rusage.ru_utime + self.rusage.ru_stime, 2)
+        ret['max_rss_kb'] = self.rusage.ru_maxrss
+        ret['peak_total_rss_kb'] = self.peakrss
+        ret['bytes_read'] = self.rusage.ru_inblock * 512
+        ret['bytes_written'] = self.rusage.ru_oublock * 512
+        ret['chars_read'] = self.iocounters['rchar']
+        ret['chars_written'] = self.iocounters['wchar']
+        return ret
+
+    # Return captured stdout lines of the finished stage
+    def outputLines(self):
+        self.outf.seek(0)
+        ret = [line.strip() for line in self.outf]
+        self.outf.close()
+        return ret
+
+# Map of parent process ids to the ids of their child processes (read from /proc)
+def readProcessTree():
+    ret = dict()
+    for x in os.listdir('/proc'):
+        if not x.isdigit(): continue
+        try: stat = open('/proc/' + x + '/stat').read()
+        except IOError: continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        ret.setdefault(ppid, []).append(int(x))
+    return ret
+
+# Write resource usage and timing of the stages of a sample to metrics file
+def writeMetrics(sample):
+    data = OrderedDict()
+    data['sample'] = sample.name
+    data['stages'] = [stage.metrics() for stage in sample.stages]
+    with open(sample.metricsfn, 'w') as out:
+        json.dump(data, out, indent=4)
+        out.write('\n')
+
+# Size and modification time of a file
+def fileSignature(fn):
+    if not os.path.exists(fn): return fn + ':missing'
+    st = os.stat(fn)
+    return fn + ':' + str(st.st_size) + ':' + str(int(st.st_mtime))
+
+# Read checksums of completed stages from checkpoint file
+def readCheckpoints(fn):
+    ret = dict()
+    if not os.path.isfile(fn): return ret
+    for line in open(fn):
+        line = line.strip()
+        if line == '': continue
+        [name, checksum] = line.split('\t')
+        ret[name] = checksum
+    return ret
+
+# Write checksums of completed stages to checkpoint file
+def writeCheckpoints(fn, checkpoints):
+    with open(fn + '.part', 'w') as out:
+        for name in sorted(checkpoints.keys()): out.write(name + '\t' + checkpoints[name] + '\n')
+    os.rename(fn + '.part', fn)
+
+# Split script of a sample into preamble (everything before the first stage) and stages, and connect stages to the earlier stages creating their inputs
+def readStages(fn, sample):
+    preamble = ''
+    stages = []
+    for line in open(fn):
+        if line.startswith('#@stage'): stages.append(Stage(line.split()[1], sample, preamble))
+        elif len(stages) == 0: preamble += line
+        else: stages[-1].addLine(line)
+    for i in range(len(stages)):
+        for j in range(i):
+            if len(set(stages[i].inputs) & set(stages[j].outputs)) > 0: stages[i].dependencies.append(stages[j])
+    return stages
+
+# Write captured stdout lines of a stage to log file
+def writeLog(logf, lines):
+    for stdout_line in lines:
+        if stdout_line.startswith('OPEXMSG'): logf.write('\n\n'+'='*120+'\nOPEX: '+stdout_line[8:]+'\n'+'='*120+'\n\n')
+        else: logf.write(stdout_line + '\n')
+    logf.flush()
+
+# Execute stages (of all samples) on a shared pool, running stages whose dependencies have finished concurrently as long
+# as the processes and memory they use fit in the budgets. Of the stages that fit, I/O heavy (#@io) and CPU heavy stages
+# are interleaved, otherwise stages are started in sample and script order. Checksums of completed stages are recorded
+# in the checkpoint file of the sample, and stages completed by a previous run with the same checksum are skipped. When
+# a stage fails, its dependents are not started and the run of the sample is terminated
+def executeStages(stages, threads, memory, paramfiles):
+    waiting = list(stages)
+    running = []
+    finished = set()
+    failed = set()
+    while len(running) > 0 or any(not stage.sample.terminated for stage in waiting):
+
+        # Start ready stages while they fit in the budgets
+        while True:
+            usedthreads = sum(s.threads for s in running)
+            usedmemory = sum(s.memory for s in running)
+            candidates = []
+            for stage in list(waiting):
+                if stage.sample.terminated or any(dep in failed for dep in stage.dependencies): continue
+                if not all(dep in finished for dep in stage.dependencies): continue
+                stage.calculateChecksum(paramfiles)
+                if stage.upToDate():
+                    report(stage.sample.label + 'Stage ' + stage.name + ' is up to date, skipped')
+                    writeLog(stage.sample.logf, ['OPEXMSG Stage ' + stage.name + ' is up to date, skipped'])
+                    waiting.remove(stage)
+                    finished.add(stage)
+                    stage.status = 'skipped'
+                    continue
+                if len(running) > 0 and usedthreads + stage.threads > threads: continue
+                if len(running) > 0 and memory is not None and usedmemory + stage.memory > memory: continue
+                candidates.append(stage)
+            if len(candidates) == 0: break
+            stage = min(candidates, key=lambda x: sum(1 for s in running if s.io == x.io))
+
+            waiting.remove(stage)
+            missing = stage.missingInputs()
+            if len(missing) > 0:
+                writeLog(stage.sample.logf, ['OpEx error: ' + missing[0] + ' does not exist.', 'Cannot proceed with this step. OpEx run terminated.'])
+                stage.sample.terminated = True
+                continue
+            if stage.name in stage.sample.checkpoints:
+                del stage.sample.checkpoints[stage.name]
+                writeCheckpoints(stage.sample.checkpointfn, stage.sample.checkpoints)
+            if stage.message is not None: report(stage.sample.label + stage.message)
+            stage.start()
+            running.append(stage)
+
+        time.sleep(1)
+
+        # Sample resource usage of running stages
+        children = readProcessTree()
+        for stage in running: stage.sampleUsage(children)
+
+        # Collect finished stages, releasing the dependents of the ones completed successfully
+        for stage in list(running):
+            if not stage.finished(): continue
+            writeLog(stage.sample.logf, stage.outputLines())
+            running.remove(stage)
+            if stage.process.returncode == 0 and stage.outputsExist():
+                finished.add(stage)
+                stage.status = 'completed'
+                stage.sample.checkpoints[stage.name] = stage.checksum
+                writeCheckpoints(stage.sample.checkpointfn, stage.sample.checkpoints)
+            else:
+                failed.add(stage)
+                stage.status = 'failed'
+                stage.sample.terminated = True
+                report(stage.sample.label + 'Stage ' + stage.name + ' failed')
+                writeLog(stage.sample.logf, ['OpEx error: stage ' + stage.name + ' failed (exit code ' + str(stage.process.returncode) + ').',
+                                             'Cannot proceed with this step. OpEx run terminated.'])
+            writeMetrics(stage.sample)
 
 # Write status message to stdout
 def report(info):
@@ -115,62 +526,105 @@ descr = 'OpEx (Optimised Exome) pipeline ' + ver + '.'
 parser = OptionParser(usage='python opex.py <options>', version=ver, description=descr)
 parser.add_option('-i', "--input", default=None, dest='fastq', action='store', help="fastq.gz files")
 parser.add_option('-o', "--output", default=None, dest='name', action='store', help="Sample name (output prefix)")
+parser.add_option('-s', "--samples", default=None, dest='samples', action='store', help="Sample sheet (sample name, fastq.gz file 1 and fastq.gz file 2 tab separated in each line), replacing options --input and --output")
 parser.add_option('-b', "--bed", default=None, dest='bed', action='store', help="Bed file")
 parser.add_option('-t', "--threads", default=1, dest='threads', action='store', help="Number of processes to use")
+parser.add_option('-m', "--memory", default=None, dest='memory', action='store', help="Memory (Gb) available for stages running concurrently (default: total memory)")
 parser.add_option('-c', "--config", default=None, dest='config', action='store', help="Configuration file")
 parser.add_option('-k', "--keep", default=False, dest='keep', action='store_true', help="Keep temporary files")
+parser.add_option('-r', "--resume", default=False, dest='resume', action='store_true', help="Skip stages completed by a previous run with the same inputs and parameters (the variant calling and annotation of region shards is re-run if the number of shards changes with --threads, or if the shard files were removed after gathering, i.e. without --keep)")
 (options, args) = parser.parse_args()
 options = checkOptions(options)
 
+# Samples to be processed
+if options.samples is not None: samples = readSampleSheet(options.samples)
+else: samples = [Sample(options.name, options.fastq.split(',')[0], options.fastq.split(',')[1])]
+if len(samples) > 1:
+    for sample in samples: sample.label = sample.name + ': '
+
 # Start date and time
 starttime = datetime.datetime.now()
 
 # Printing out run information
 print '\n= OpEx '+ver+' '+'='*100
 print '\nAbout this run:\n'+'-'*16
-print 'Input fastq.gz files: ' + options.fastq
+if options.samples is not None: print 'Sample sheet: ' + options.samples + ' (' + str(len(samples)) + ' samples)'
+else: print 'Input fastq.gz files: ' + options.fastq
 if not options.bed is None: print 'Bed file: ' + options.bed
 if not options.config is None: print 'Configuration file: ' + options.config
-print 'Output files prefix: ' + options.name
+if options.samples is None: print 'Output files prefix: ' + options.name
 if int(options.threads) > 1: print 'Number of threads: ' + str(options.threads)
+if options.memory is not None: print 'Memory: ' + str(options.memory) + ' Gb'
+if options.resume: print 'Resuming previous run'
 print '-'*100 + '\n'
-print '[More information in '+options.name + '_opex_log.txt]\n'
+if options.samples is not None: print '[More information in SAMPLE_opex_log.txt files]\n'
+else: print '[More information in '+options.name + '_opex_log.txt]\n'
 
 # Read configuration file
-params = readConfigFile(scriptdir, options.config)
-
-# Additional params
-params['NAME'] = options.name
-params['FASTQ1'], params['FASTQ2'] = options.fastq.split(',')
-params['OPEXDIR'] = scriptdir
-params['MORECV'] = '-c ' + params['COVERVIEW_CONFIG']
-if options.bed is not None: params['MORECV'] = params['MORECV'] + ' -b ' + options.bed
-if int(options.threads) > 1: params['MORECV'] = params['MORECV'] + ' -t ' + str(options.threads)
-params['MORECAVA'] = ''
-if int(options.threads) > 1: params['MORECAVA'] = params['MORECAVA'] + '-t ' + str(options.threads)
-if options.keep: params['KEEPREMOVE'] = ''
-else: params['KEEPREMOVE'] = 'rm -r ' + params['NAME'] + '_tmp'
-
-# Genearate Bash script file
-scriptfn = params['NAME'] + '_opex_pipeline.sh'
-generateFile(params, scriptdir + '/templates/opex_pipeline_template', scriptfn)
-makeExecutable(scriptfn)
-
-# Running Bash script and capturing stdout
+config = readConfigFile(scriptdir, options.config)
+
+# Processes available to the stages of each sample; CoverView leaves one process for Platypus, which can run alongside it
+samplethreads = max(1, int(options.threads) / len(samples))
+cvthreads = max(1, samplethreads - 1)
+
+# Region shards of Platypus calling and CAVA annotation (one per process of a sample), based on bed file if given
+chromlengths = readChromLengths(config['REFERENCE'])
+if samplethreads > 1 and len(chromlengths) > 0:
+    shards = makeShards(chromlengths, None if options.bed is None else readBedIntervals(options.bed), samplethreads)
+else:
+    shards = [[]]
+cavathreads = max(1, samplethreads / len(shards))
+
+# Genearate Bash script file of each sample and read its stages
+stages = []
+paramfiles = [value for value in config.values() if os.path.isfile(value)]
+if options.bed is not None: paramfiles.append(options.bed)
+for sample in samples:
+
+    # Additional params
+    params = OrderedDict(config)
+    params['NAME'] = sample.name
+    params['FASTQ1'], params['FASTQ2'] = sample.fastq1, sample.fastq2
+    params['OPEXDIR'] = scriptdir
+    params['MORECV'] = '-c ' + params['COVERVIEW_CONFIG']
+    if options.bed is not None: params['MORECV'] = params['MORECV'] + ' -b ' + options.bed
+    params['CVTHREADS'] = str(cvthreads)
+    if cvthreads > 1: params['MORECV'] = params['MORECV'] + ' -t ' + str(cvthreads)
+    params['CAVATHREADS'] = str(cavathreads)
+    params['MORECAVA'] = ''
+    if cavathreads > 1: params['MORECAVA'] = params['MORECAVA'] + '-t ' + str(cavathreads)
+    if options.keep: params['KEEPREMOVE'] = ''
+    else: params['KEEPREMOVE'] = 'rm -r ' + params['NAME'] + '_tmp'
+    if options.keep: params['REMOVESHARDS'] = ''
+    else: params['REMOVESHARDS'] = 'rm -r ' + params['NAME'] + '_shards'
+
+    scriptfn = params['NAME'] + '_opex_pipeline.sh'
+    generateFile(params, scriptdir + '/templates/opex_pipeline_template', scriptfn, shards)
+    makeExecutable(scriptfn)
+    sample.stages = readStages(scriptfn, sample)
+    stages.extend(sample.stages)
+    paramfiles.extend([sample.fastq1, sample.fastq2])
+
+    if options.resume: sample.checkpoints = readCheckpoints(sample.checkpointfn)
+    sample.logf = open(sample.name + '_opex_log.txt', 'a' if options.resume else 'w')
+
+# Running stages of the Bash scripts and capturing stdout
 print datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ': OpEx pipeline started'; sys.stdout.flush()
-logf = open(options.name + '_opex_log.txt', 'w')
-for stdout_line in executeScript('./'+scriptfn):
-    if stdout_line.startswith('OPEXMSG'):
-        print datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ': ' + stdout_line[8:]; sys.stdout.flush()
-        logf.write('\n\n'+'='*120+'\nOPEX: '+stdout_line[8:]+'\n'+'='*120+'\n\n'); logf.flush()
-    else:
-        logf.write(stdout_line + '\n'); logf.flush()
-logf.close()
+executeStages(stages, int(options.threads), None if options.memory is None else int(options.memory), paramfiles)
+for sample in samples:
+    sample.logf.close()
+    writeMetrics(sample)
 
 # Conclusion and runtime
 print datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ': OpEx pipeline finished'; sys.stdout.flush()
 runtime = str(datetime.datetime.now()-starttime)[:-4]
-if os.path.isfile(options.name + '_annotated_calls.txt') and os.path.getsize(options.name + '_annotated_calls.txt') > 0:
+succeeded = [os.path.isfile(sample.name + '_annotated_calls.txt') and os.path.getsize(sample.name + '_annotated_calls.txt') > 0 for sample in samples]
+if len(samples) > 1:
+    print ''
+    for i in range(len(samples)):
+        print 'Analysis of sample ' + samples[i].name + (' has been successful.' if succeeded[i] else ' has failed.')
+    print '\n' + str(sum(succeeded)) + ' of ' + str(len(samples)) + ' samples analysed successfully. Total runtime: ' + runtime
+elif succeeded[0]:
     print '\nAnalysis of sample has been successful. Total runtime: ' + runtime
 else:
     print '\nAnalysis of sample has failed. Total runtime: ' + runtime
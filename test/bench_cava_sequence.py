@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of CAVA Sequence.translate and Sequence.reverseComplement against the previous (per codon and per
+# base concatenating) implementation, on sequences with the coding sequence lengths of the transcript database
+# Usage: python test/bench_cava_sequence.py [-n number of transcripts] [-e transcript database]
+
+import os
+import sys
+import time
+import gzip
+import random
+from optparse import OptionParser
+
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, scriptdir + '/../tools/CAVA-1.2.0')
+import core
+
+
+# Previous implementation of Sequence.translate
+def translateOld(seq, letter):
+    if letter == 1: gencode = dict((k, v) for k, v in core.gencode1.iteritems() if 'N' not in k)
+    if letter == 3: gencode = dict((k, v) for k, v in core.gencode3.iteritems() if 'N' not in k)
+    ret = ''
+    index = 0
+    while index + 3 <= len(seq):
+        codon = seq[index:index + 3].upper()
+        if 'N' in codon:
+            ret += '?'
+            index += 3
+            continue
+        ret += gencode[codon]
+        index += 3
+    return ret
+
+# Previous implementation of Sequence.reverseComplement
+def reverseComplementOld(seq):
+    complement = {"A": "T", "T": "A", "C": "G", "G": "C", "N": "N", "a": "t", "t": "a", "c": "g", "g": "c", "n": "n"}
+    ret = ''
+    for base in seq[::-1]: ret += complement[base]
+    return ret
+
+# Coding sequence lengths (protein length + stop codon, read from the TRINFO column) of transcripts in the database
+def readCDSLengths(fn):
+    ret = []
+    for line in gzip.open(fn):
+        cols = line.rstrip('\n').split('\t')
+        if len(cols) < 4: continue
+        ret.append(3 * (int(cols[3].split('/')[-1]) + 1))
+    return ret
+
+# Running time (seconds) of applying function to all sequences
+def timeit(func, seqs):
+    t0 = time.time()
+    for seq in seqs: func(seq)
+    return time.time() - t0
+
+
+parser = OptionParser(usage='python test/bench_cava_sequence.py <options>')
+parser.add_option('-e', "--ensembl", default=scriptdir + '/../defaultdb/ensembl75s.gz', dest='ensembl', action='store', help="Transcript database file")
+parser.add_option('-n', "--number", default=2000, dest='number', action='store', help="Number of transcripts sampled")
+(options, args) = parser.parse_args()
+
+random.seed(1)
+lengths = readCDSLengths(options.ensembl)
+lengths = random.sample(lengths, min(int(options.number), len(lengths)))
+seqs = [core.Sequence(''.join(random.choice('ACGT') for _ in xrange(length))) for length in lengths]
+kb = sum(lengths) / 1000.0
+
+# Checking the two implementations give the same results
+for seq in seqs:
+    assert seq.translate(1) == translateOld(seq, 1) and seq.translate(3) == translateOld(seq, 3)
+    assert seq.reverseComplement() == reverseComplementOld(seq)
+
+print '%d coding sequences, median length %d bp, %.1f kb in total' % (len(seqs), sorted(lengths)[len(lengths) / 2], kb)
+for name, old, new in [
+    ('translate(1)', lambda x: translateOld(x, 1), lambda x: x.translate(1)),
+    ('translate(3)', lambda x: translateOld(x, 3), lambda x: x.translate(3)),
+    ('reverseComplement', reverseComplementOld, lambda x: x.reverseComplement())]:
+    told, tnew = timeit(old, seqs), timeit(new, seqs)
+    print '%-18s old %8.1f us/kb   new %8.1f us/kb   speedup %.1fx' % (name, told * 1e6 / kb, tnew * 1e6 / kb, told / tnew)
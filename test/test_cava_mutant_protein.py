@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Differential test of CAVA Transcript.getMutantProteinSequence (retranslating only the codons affected by a variant)
+# against Transcript.getProteinSequence (retranslating the whole mutant coding sequence). Random SNVs, insertions,
+# deletions and complex variants are placed in coding exons, at exon boundaries and around the start and stop codons,
+# and the CSN, PROTPOS, PROTREF, PROTALT, CLASS and SO annotations obtained from the two mutant proteins are compared.
+# Usage: python test/test_cava_mutant_protein.py [-r reference genome] [-c chromosome] [-n number of transcripts]
+
+import os
+import sys
+import gzip
+import random
+from optparse import OptionParser
+
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, scriptdir + '/../tools/CAVA-1.2.0')
+import core
+import csn
+import conseq
+from data import Reference
+
+
+# Class providing the reference genome file name in the form expected by data.Reference
+class ReferenceOptions(object):
+    # Constructor
+    def __init__(self, reference):
+        self.args = {'reference': reference}
+
+
+# Reference genome file specified in the OpEx configuration file
+def referenceFromConfig():
+    if not os.path.isfile(scriptdir + '/../config.txt'): return None
+    for line in open(scriptdir + '/../config.txt'):
+        line = line.strip()
+        if line.startswith('#') or not '=' in line: continue
+        [key, value] = line.split('=', 1)
+        if key.strip().upper() == 'REFERENCE' and value.strip() not in ['', '.']: return value.strip()
+    return None
+
+# Random variant in or around the coding region of transcript
+def randomVariant(transcript, reference, k):
+    exon = random.choice(transcript.exons)
+    if k % 3 == 0:
+        pos = random.choice([exon.start + 1, exon.start + 2, exon.end, exon.end - 1,
+                             transcript.codingStartGenomic, transcript.codingEndGenomic,
+                             transcript.codingStartGenomic + random.randint(-3, 3), transcript.codingEndGenomic + random.randint(-3, 3)])
+    else:
+        pos = random.randint(exon.start + 1, exon.end)
+    kind = random.choice(['snv', 'ins', 'del', 'complex'])
+    if kind == 'snv':
+        ref = reference.getReference(transcript.chrom, pos, pos)
+        alt = random.choice([b for b in 'ACGT' if not b == ref])
+    elif kind == 'ins':
+        ref, alt = '', ''.join(random.choice('ACGT') for _ in range(random.randint(1, 7)))
+    elif kind == 'del':
+        ref, alt = reference.getReference(transcript.chrom, pos, pos + random.randint(0, 7)), ''
+    else:
+        ref = reference.getReference(transcript.chrom, pos, pos + random.randint(1, 6))
+        alt = ''.join(random.choice('ACGT') for _ in range(random.randint(1, 7)))
+    if ref is None: return None
+    return core.Variant(transcript.chrom, pos, core.Sequence(ref), core.Sequence(alt))
+
+# Annotations depending on the mutant protein
+def annotations(variant, transcript, reference, protein, mutprotein, loc):
+    ret = []
+    for func in [lambda: csn.getAnnotation(variant, transcript, reference, protein, mutprotein)[0].getAsString(),
+                 lambda: csn.getAnnotation(variant, transcript, reference, protein, mutprotein)[1],
+                 lambda: conseq.getClassAnnotation(variant, transcript, protein, mutprotein, loc, 8),
+                 lambda: conseq.getSequenceOntologyAnnotation(variant, transcript, protein, mutprotein, loc)]:
+        try: ret.append(func())
+        except Exception as e: ret.append('Exception: ' + type(e).__name__)
+    return ret
+
+
+parser = OptionParser(usage='python test/test_cava_mutant_protein.py <options>')
+parser.add_option('-r', "--reference", default=None, dest='reference', action='store', help="Reference genome file (default: REFERENCE of config.txt)")
+parser.add_option('-e', "--ensembl", default=scriptdir + '/../defaultdb/ensembl75s.gz', dest='ensembl', action='store', help="Transcript database file")
+parser.add_option('-c', "--chrom", default='13', dest='chrom', action='store', help="Chromosome of the transcripts tested")
+parser.add_option('-n', "--number", default=1000, dest='number', action='store', help="Number of transcripts tested")
+parser.add_option('-v', "--variants", default=60, dest='variants', action='store', help="Number of variants per transcript")
+parser.add_option('-s', "--seed", default=7, dest='seed', action='store', help="Random seed")
+(options, args) = parser.parse_args()
+
+if options.reference is None: options.reference = referenceFromConfig()
+if options.reference is None or not os.path.isfile(options.reference + '.fai'):
+    print '\nReference genome file (with .fa.fai index) not found. Please use option -r.\n'
+    quit()
+reference = Reference(ReferenceOptions(options.reference))
+
+random.seed(int(options.seed))
+transcripts = []
+for line in gzip.open(options.ensembl):
+    transcript = core.Transcript(line.rstrip('\n'), reference)
+    if transcript.chrom == options.chrom: transcripts.append(transcript)
+transcripts = transcripts[:int(options.number)]
+
+tested, identical, frameshifts, fallbacks, failures = 0, 0, 0, 0, 0
+for transcript in transcripts:
+    try: protein, exonseqs = transcript.getProteinSequence(reference, None, None)
+    except KeyError: continue
+    for k in range(int(options.variants)):
+        variant = randomVariant(transcript, reference, k)
+        if variant is None: continue
+        tested += 1
+        old, _ = transcript.getProteinSequence(reference, variant, exonseqs)
+        new = transcript.getMutantProteinSequence(variant, protein, exonseqs)
+        if new is None:
+            fallbacks += 1
+            continue
+
+        # Frameshifted mutant proteins may differ after the first stop codon, which is not used by the annotations
+        stop = old.find('X') + 1
+        if old == new: identical += 1
+        elif not variant.isInFrame() and stop > 0 and old[:stop] == new[:stop]: frameshifts += 1
+        else:
+            failures += 1
+            print 'Mutant protein differs: ' + transcript.TRANSCRIPT + ' ' + str(variant.pos) + ' ' + variant.ref + '>' + variant.alt
+            continue
+
+        loc = transcript.whereIsThisVariant(variant)
+        if ('5UTR' in loc) or ('3UTR' in loc) or ('-' in loc) or ('In' in loc) or (loc == 'OUT') or (loc == '.'): continue
+        x = annotations(variant, transcript, reference, protein, old, loc)
+        y = annotations(variant, transcript, reference, protein, new, loc)
+        if not x == y:
+            failures += 1
+            print 'Annotations differ: ' + transcript.TRANSCRIPT + ' ' + str(variant.pos) + ' ' + variant.ref + '>' + variant.alt + ': ' + str(x) + ' vs ' + str(y)
+
+print '\n' + str(tested) + ' variants in ' + str(len(transcripts)) + ' transcripts tested: ' + str(identical) + ' identical mutant proteins, ' + \
+      str(frameshifts) + ' frameshifts differing after the stop codon, ' + str(fallbacks) + ' computed by full retranslation'
+if failures > 0:
+    print str(failures) + ' differences found.\n'
+    sys.exit(1)
+print 'No differences found.\n'
@@ -11,6 +11,10 @@ import sys
 import datetime
 import logging
 import gzip
+import cStringIO
+import Queue
+import struct
+import bisect
 from optparse import OptionParser
 import multiprocessing
 
@@ -66,9 +70,12 @@ def printInputFileNames(copts, options):
             logging.info('Multithreading - ' + str(copts.threads) + ' threads')
 
 
-# Printing out number of records in the input file
-def printNumOfRecords(numOfRecords):
-    print '\nInput file contains ' + str(numOfRecords) + ' records to annotate.\n'
+# Printing out number of records (or size, if records were not counted) of the input file
+def printNumOfRecords(numOfRecords, inputfn):
+    if numOfRecords is None:
+        print '\nInput file size: ' + str(round(os.stat(inputfn).st_size / 1000, 1)) + ' Kbyte\n'
+    else:
+        print '\nInput file contains ' + str(numOfRecords) + ' records to annotate.\n'
 
 
 # Initializing progress information
@@ -78,8 +85,9 @@ def initProgressInfo():
 
 
 # Printing out progress information
-def printProgressInfo(counter, numOfRecords):
-    x = round(100 * counter / numOfRecords, 1)
+def printProgressInfo(done, total):
+    if total > 0: x = round(100 * done / total, 1)
+    else: x = 100.0
     x = min(x, 100.0)
     sys.stdout.write('\rAnnotating variants ... ' + str(x) + '%')
     sys.stdout.flush()
@@ -110,49 +118,190 @@ def printEndInfo(options, copts, starttime):
         logging.info('CAVA successfully finished.')
 
 
-# Finding break points in the input file
-def findFileBreaks(inputf, threads):
-    ret = []
+# Scanning the input file: reading the header and finding break points (and the number of records, if required)
+def scanInput(inputf, threads):
+    if inputf.endswith('.gz') and not isBGZF(inputf): return scanLines(inputf, threads)
+
+    # Record-aligned byte offsets (uncompressed offsets in BGZF files), no need to read past the header
+    blocks = readBlockOffsets(inputf)
+    header, headerend = readHeader(inputf, blocks)
+    if blocks is None: total = os.path.getsize(inputf)
+    else: total = blocks[-1][1] + blocks[-1][2]
+
+    points = [headerend]
+    for i in range(1, threads):
+        pos = headerend + int((total - headerend) * i / threads)
+        if pos <= points[-1]:
+            points.append(points[-1])
+            continue
+        infile = openInputAt(inputf, blocks, pos - 1)
+        points.append(min(pos - 1 + len(infile.readline()), total))
+        infile.close()
+    points.append(total)
+
+    breaks = []
+    for i in range(threads):
+        offset, skip = locateOffset(blocks, points[i])
+        breaks.append({'offset': offset, 'skip': skip, 'length': points[i + 1] - points[i]})
+    return header, None, breaks
+
+
+# Scanning the input file line by line (used for gzip files that are not BGZF compressed)
+def scanLines(inputf, threads):
+    header = []
+    numOfRecords = 0
     started = False
     counter = 0
 
-    if inputf.endswith('.gz'): infile = gzip.open(inputf, 'r')
-    else: infile = open(inputf)
+    infile = gzip.open(inputf, 'r')
 
     for line in infile:
         counter += 1
         line = line.strip()
-        if line == '' or line.startswith('#'): continue
+        if line == '': continue
+        if line.startswith('#'):
+            if not started: header.append(line)
+            continue
+        numOfRecords += 1
         if not started:
             started = True
             first = counter
+    infile.close()
+
+    if not started: first = counter + 1
     delta = int((counter - first + 1) / threads)
+    breaks = []
     for i in range(threads):
         if i < threads - 1:
-            ret.append((first + i * delta, first + (i + 1) * delta - 1))
+            breaks.append({'startline': first + i * delta, 'endline': first + (i + 1) * delta - 1})
         else:
-            ret.append((first + i * delta, ''))
-    return ret
+            breaks.append({'startline': first + i * delta, 'endline': ''})
+    return header, numOfRecords, breaks
 
 
-# Reading header from input file
-def readHeader(inputfn):
-    ret = []
+# Checking if a .gz file is BGZF compressed (i.e. each block carries the BC extra subfield)
+def isBGZF(inputf):
+    with open(inputf, 'rb') as infile:
+        header = infile.read(18)
+    if len(header) < 18: return False
+    return header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
 
-    if inputfn.endswith('.gz'): infile = gzip.open(inputfn, 'r')
-    else: infile = open(inputfn)
 
-    for line in infile:
-        line = line.strip()
-        if line == '': continue
-        if line.startswith("#"):
-            ret.append(line)
-        else:
-            break
+# Reading compressed offset, uncompressed offset and uncompressed size of each BGZF block (None for plain text files)
+def readBlockOffsets(inputf):
+    if not inputf.endswith('.gz'): return None
 
+    ret = []
+    coffset = 0
+    uoffset = 0
+    filesize = os.path.getsize(inputf)
+    with open(inputf, 'rb') as infile:
+        while coffset < filesize:
+            infile.seek(coffset)
+            header = infile.read(12)
+            xlen = struct.unpack('<H', header[10:12])[0]
+            extra = infile.read(xlen)
+            bsize = None
+            i = 0
+            while i + 4 <= xlen:
+                slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+                if extra[i:i + 2] == 'BC': bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+                i += 4 + slen
+            infile.seek(coffset + bsize + 1 - 4)
+            isize = struct.unpack('<I', infile.read(4))[0]
+            ret.append((coffset, uoffset, isize))
+            coffset += bsize + 1
+            uoffset += isize
     return ret
 
 
+# Converting an uncompressed offset to the containing block's compressed offset and the offset within that block
+def locateOffset(blocks, pos):
+    if blocks is None: return pos, 0
+    idx = bisect.bisect_right([b[1] for b in blocks], pos) - 1
+    return blocks[idx][0], pos - blocks[idx][1]
+
+
+# Opening the input file positioned at a given uncompressed offset
+def openInputAt(inputf, blocks, pos):
+    offset, skip = locateOffset(blocks, pos)
+    return openInputShard(inputf, {'offset': offset, 'skip': skip})
+
+
+# Opening the input file positioned at the start of a shard
+def openInputShard(inputf, shard):
+    if not inputf.endswith('.gz'):
+        infile = open(inputf)
+        infile.seek(shard['offset'])
+        return infile
+    rawfile = open(inputf, 'rb')
+    rawfile.seek(shard['offset'])
+    infile = gzip.GzipFile(fileobj=rawfile, mode='rb')
+    if shard['skip'] > 0: infile.read(shard['skip'])
+    return infile
+
+
+# Reading header from input file, together with the uncompressed offset of the first record
+def readHeader(inputf, blocks):
+    ret = []
+    headerend = 0
+
+    infile = openInputAt(inputf, blocks, 0)
+    while True:
+        line = infile.readline()
+        if line == '': break
+        if not (line.strip() == '' or line.startswith('#')): break
+        if not line.strip() == '': ret.append(line.strip())
+        headerend += len(line)
+    infile.close()
+
+    return ret, headerend
+
+
+# Writing annotated batches of the streaming annotation processes to the output in input order
+# (a failed reader or annotation process terminates all the others, as the rest would wait on the queues forever;
+# errors go to stderr, as the output may be written to stdout)
+def writeStreamOutput(resultqueue, outfile, reader, processes, options, copts):
+    pending = dict()
+    nextidx = 0
+    finished = 0
+    thr = 10
+    if not copts.stdout: initProgressInfo()
+    while finished < len(processes):
+        try:
+            result = resultqueue.get(timeout=1)
+        except Queue.Empty:
+            if reader.exitcode is not None and not reader.exitcode == 0:
+                for p in processes: p.terminate()
+                sys.stderr.write('\nError: reading input file failed.\n\n')
+                quit()
+            for process in processes:
+                if process.exitcode is not None and not process.exitcode == 0:
+                    for p in processes: p.terminate()
+                    reader.terminate()
+                    sys.stderr.write('\nError: annotation process ' + str(process.threadidx) + ' failed.\n\n')
+                    quit()
+            continue
+        if result is None:
+            finished += 1
+            continue
+
+        # Batches finished out of order are kept until all preceding batches have been written
+        pending[result[0]] = result[1:]
+        while nextidx in pending:
+            text, pos, total = pending.pop(nextidx)
+            outfile.write(text)
+            nextidx += 1
+
+            if not copts.stdout and nextidx % 2 == 0: printProgressInfo(pos, total)
+            if options.args['logfile']:
+                x = min(round(100 * pos / total, 1), 100.0) if total > 0 else 100.0
+                if x > thr:
+                    logging.info(str(thr) + '% of records annotated.')
+                    thr += 10
+    if not copts.stdout: finalizeProgressInfo()
+
+
 # Merging tmp files to final output file
 def mergeTmpFiles(output, format, threads):
     filenames = []
@@ -188,7 +337,7 @@ def defaultConfigPath():
 # Class representing a single annotation process
 class SingleJob(multiprocessing.Process):
     # Process constructor
-    def __init__(self, threadidx, options, copts, startline, endline, genelist, transcriptlist, snplist, impactdir,
+    def __init__(self, threadidx, options, copts, shard, genelist, transcriptlist, snplist, impactdir,
                  numOfRecords):
         multiprocessing.Process.__init__(self)
 
@@ -199,9 +348,8 @@ class SingleJob(multiprocessing.Process):
         self.options = options
         self.copts = copts
 
-        # Start and end line indexes
-        self.startline = startline
-        self.endline = endline
+        # Part of the input file processed by this process (byte offsets or line indexes)
+        self.shard = shard
 
         # Gene, transcript and SNP lists
         self.genelist = genelist
@@ -211,18 +359,24 @@ class SingleJob(multiprocessing.Process):
         # Impact defintion directory
         self.impactdir = impactdir
 
-        # Total number of records in the input file
+        # Total number of records in the input file (None if not counted)
         self.numOfRecords = numOfRecords
 
         # Allowed chromosomes
         self.chroms = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17',
                        '18', '19', '20', '21', '22', 'X', 'Y', 'MT']
 
+        # Ensembl, dbSNP databases, reference genome and target BED file
+        self.connectDatabases()
+
+        # Input and output files are handled by the reader and the writer in streaming mode
+        if shard is None: return
+
         # Input file
-        if copts.input.endswith('.gz'):
-            self.infile = gzip.open(copts.input, 'r')
+        if 'offset' in shard:
+            self.infile = openInputShard(copts.input, shard)
         else:
-            self.infile = open(copts.input)
+            self.infile = gzip.open(copts.input, 'r')
 
         # Output file
         if copts.threads > 1:
@@ -238,9 +392,14 @@ class SingleJob(multiprocessing.Process):
                 outfn = copts.output + '.txt'
             self.outfile = open(outfn, 'a')
 
-        # Ensembl, dbSNP databases
+        if not copts.stdout and threadidx == 1: initProgressInfo()
+
+    # Connecting to the Ensembl, dbSNP, reference genome and target BED files
+    def connectDatabases(self):
+        options = self.options
+        threadidx = self.threadidx
         if (not options.args['ensembl'] == '.') and (not options.args['ensembl'] == ''):
-            self.ensembl = Ensembl(options, genelist, transcriptlist)
+            self.ensembl = Ensembl(options, self.genelist, self.transcriptlist)
             if options.args['logfile'] and threadidx == 1: logging.info('Connected to Ensembl database.')
         else:
             self.ensembl = None
@@ -261,7 +420,37 @@ class SingleJob(multiprocessing.Process):
         else:
             self.targetBED = None
 
-        if not copts.stdout and threadidx == 1: initProgressInfo()
+    # Annotating a single input line and writing the output record
+    def annotateLine(self, line, outfile, stdout):
+        # Parsing record from input file
+        record = Record(line, self.options, self.targetBED)
+
+        # Filtering out REFCALL records
+        if record.filter == 'REFCALL': return
+
+        # Filtering record, if required
+        if self.options.args['filter'] and not record.filter == 'PASS': return
+
+        # Only include records of allowed chromosome names
+        if record.chrom not in self.chroms: return
+
+        # Annotating the record based on the Ensembl, dbSNP and reference data
+        record.annotate(self.ensembl, self.dbsnp, self.reference, self.impactdir)
+
+        # Writing annotated record to output file
+        record.output(self.options.args['outputformat'], outfile, self.options, self.genelist, self.transcriptlist, self.snplist, stdout)
+
+    # Writing usage of the transcript sequence cache and the reference genome to the log file
+    def logCacheStats(self):
+        if not self.options.args['logfile']: return
+        if self.ensembl is not None:
+            logging.info('Process ' + str(self.threadidx) + ' - sequence cache: ' + self.ensembl.seqCache.summary())
+        logging.info('Process ' + str(self.threadidx) + ' - reference genome: ' + self.reference.summary())
+
+    # Getting progress of the process (done and total, in bytes or records)
+    def progress(self, counter, consumed):
+        if 'offset' in self.shard: return consumed, self.shard['length']
+        return counter - int(self.shard['startline']) + 1, int(self.numOfRecords / self.copts.threads)
 
     # Running process
     def run(self):
@@ -270,55 +459,121 @@ class SingleJob(multiprocessing.Process):
 
         # Iterating through input file
         counter = 0
+        consumed = 0
         thr = 10
         for line in self.infile:
             counter += 1
 
-            # Considering lines between startline and endline only
-            if counter < int(self.startline): continue
-            if not self.endline == '':
-                if counter > int(self.endline): break
+            # Considering lines of the shard only
+            if 'offset' in self.shard:
+                consumed += len(line)
+                if consumed > self.shard['length']: break
+            else:
+                if counter < int(self.shard['startline']): continue
+                if not self.shard['endline'] == '':
+                    if counter > int(self.shard['endline']): break
 
             line = line.strip()
             if line == '': continue
 
             # Printing out progress information
             if not copts.stdout and self.threadidx == 1:
-                if counter % 1000 == 0: printProgressInfo(counter, int(self.numOfRecords / self.copts.threads))
-
-            # Parsing record from input file
-            record = Record(line, self.options, self.targetBED)
-
-            # Filtering out REFCALL records
-            if record.filter == 'REFCALL': continue
-
-            # Filtering record, if required
-            if self.options.args['filter'] and not record.filter == 'PASS': continue
-
-            # Only include records of allowed chromosome names
-            if record.chrom not in self.chroms: continue
-
-            # Annotating the record based on the Ensembl, dbSNP and reference data
-            record.annotate(self.ensembl, self.dbsnp, self.reference, self.impactdir)
+                if counter % 1000 == 0: printProgressInfo(*self.progress(counter, consumed))
 
-            # Writing annotated record to output file
-            record.output(self.options.args['outputformat'], self.outfile, self.options, self.genelist, self.transcriptlist, self.snplist, self.copts.stdout)
+            # Annotating record and writing it to output file
+            self.annotateLine(line, self.outfile, self.copts.stdout)
 
             # Writing progress information to log file
             if self.threadidx == 1 and self.options.args['logfile']:
-                x = round(100 * counter / int(self.numOfRecords / self.copts.threads), 1)
-                x = min(x, 100.0)
+                done, total = self.progress(counter, consumed)
+                if total > 0: x = min(round(100 * done / total, 1), 100.0)
+                else: x = 100.0
                 if x > thr:
                     logging.info(str(thr) + '% of records annotated.')
                     thr += 10
 
         # Closing output file
         self.outfile.close()
+        self.logCacheStats()
 
         # Finalizing progreaa info
         if not copts.stdout and self.threadidx == 1: finalizeProgressInfo()
 
 
+# Class representing the reader process of streaming mode, feeding batches of input lines to the annotation processes
+class StreamReader(multiprocessing.Process):
+    # Process constructor
+    def __init__(self, inputf, taskqueue, numOfJobs, batchsize):
+        multiprocessing.Process.__init__(self)
+
+        # Input file name
+        self.inputf = inputf
+
+        # Queue of batches and number of annotation processes to be notified at the end of the input
+        self.taskqueue = taskqueue
+        self.numOfJobs = numOfJobs
+
+        # Number of input lines in a batch
+        self.batchsize = batchsize
+
+    # Running process
+    def run(self):
+        total = os.path.getsize(self.inputf)
+        rawfile = open(self.inputf, 'rb')
+        if self.inputf.endswith('.gz'): infile = gzip.GzipFile(fileobj=rawfile, mode='rb')
+        else: infile = rawfile
+
+        # Batches are sent together with their index and the (compressed) position in the input file
+        batchidx = 0
+        consumed = 0
+        lines = []
+        for line in infile:
+            consumed += len(line)
+            line = line.strip()
+            if line == '' or line.startswith('#'): continue
+            lines.append(line)
+            if len(lines) == self.batchsize:
+                if infile is rawfile: pos = consumed
+                else: pos = rawfile.tell()
+                self.taskqueue.put((batchidx, lines, pos, total))
+                batchidx += 1
+                lines = []
+        if len(lines) > 0: self.taskqueue.put((batchidx, lines, total, total))
+        infile.close()
+
+        for i in range(self.numOfJobs): self.taskqueue.put(None)
+
+
+# Class representing an annotation process of streaming mode, sending annotated batches to the writer
+class StreamJob(SingleJob):
+    # Process constructor
+    def __init__(self, threadidx, options, copts, taskqueue, resultqueue, genelist, transcriptlist, snplist, impactdir):
+        SingleJob.__init__(self, threadidx, options, copts, None, genelist, transcriptlist, snplist, impactdir, None)
+
+        # Queues of input batches and annotated batches
+        self.taskqueue = taskqueue
+        self.resultqueue = resultqueue
+
+    # Running process
+    def run(self):
+        if options.args['logfile']:
+            logging.info('Process ' + str(self.threadidx) + ' - variant annotation started.')
+
+        while True:
+            batch = self.taskqueue.get()
+            if batch is None: break
+            batchidx, lines, pos, total = batch
+
+            # Annotating records of the batch into an in-memory buffer
+            outfile = cStringIO.StringIO()
+            for line in lines: self.annotateLine(line, outfile, False)
+            self.resultqueue.put((batchidx, outfile.getvalue(), pos, total))
+            outfile.close()
+
+        self.logCacheStats()
+        self.resultqueue.put(None)
+
+
 ###########################################################################################################################################
 
 ver = 'v1.2.0'
@@ -341,9 +596,11 @@ parser.add_option('-s', "--stdout", default=False, dest='stdout', action='store_
                   help="Write output to standard output [default value: %default]")
 parser.add_option('-t', "--threads", default=1, dest='threads', action='store',
                   help="Number of threads [default value: %default]")
+parser.add_option("--stream", default=False, dest='stream', action='store_true',
+                  help="Stream batches of records through the annotation processes and write output in input order, without tmp files (allows -s with multiple threads) [default value: %default]")
 (copts, args) = parser.parse_args()
 copts.threads = int(copts.threads)
-if copts.threads > 1: copts.stdout = False
+if copts.threads > 1 and not copts.stream: copts.stdout = False
 
 # Use default path read from the default_config_path file, if -c is not used
 if copts.conf == None: copts.conf = default_config_file
@@ -393,39 +650,66 @@ if not (options.args['impactdef'] == '.' or options.args['impactdef'] == ''):
 else:
     impactdir = None
 
-# Counting and printing out number of records of input file
-numOfRecords = core.countRecords(copts.input)
-if not copts.stdout: printNumOfRecords(numOfRecords)
+# Reading header and finding break points in the input file (records are only counted if needed for the breaks)
+if copts.stream:
+    header, headerend = readHeader(copts.input, None)
+    numOfRecords = None
+else:
+    header, numOfRecords, breaks = scanInput(copts.input, copts.threads)
+if not copts.stdout: printNumOfRecords(numOfRecords, copts.input)
 if options.args['logfile']:
-    logging.info(str(numOfRecords) + ' records to be annotated.')
+    if numOfRecords is None: logging.info('Input file - ' + str(round(os.stat(copts.input).st_size / 1000, 1)) + ' Kbyte to be annotated.')
+    else: logging.info(str(numOfRecords) + ' records to be annotated.')
 
 # Writing header to output file
 if options.args['outputformat'] == 'VCF':
     outfile = open(copts.output + '.vcf', 'w')
 else:
     outfile = open(copts.output + '.txt', 'w')
-header = readHeader(copts.input)
 core.writeHeader(options, '\n'.join(header), outfile, copts.stdout)
 outfile.close()
 
-# Find break points in the input file
-breaks = findFileBreaks(copts.input, copts.threads)
-
-# Initializing annotation processes
-threadidx = 0
-processes = []
-for (startline, endline) in breaks:
-    threadidx += 1
-    processes.append(
-        SingleJob(threadidx, options, copts, startline, endline, genelist, transcriptlist, snplist, impactdir,
-                  numOfRecords))
-
-# Running annotation processes
-for process in processes: process.start()
-for process in processes: process.join()
+if copts.stream:
+    # Initializing reader and annotation processes, annotated batches are written by the main process
+    taskqueue = multiprocessing.Queue(4 * copts.threads)
+    resultqueue = multiprocessing.Queue()
+    reader = StreamReader(copts.input, taskqueue, copts.threads, 500)
+    processes = []
+    for threadidx in range(1, copts.threads + 1):
+        processes.append(
+            StreamJob(threadidx, options, copts, taskqueue, resultqueue, genelist, transcriptlist, snplist, impactdir))
+
+    # Running annotation processes (header must be flushed before forking)
+    sys.stdout.flush()
+    reader.start()
+    for process in processes: process.start()
+    if copts.stdout:
+        outfile = sys.stdout
+    elif options.args['outputformat'] == 'VCF':
+        outfile = open(copts.output + '.vcf', 'a')
+    else:
+        outfile = open(copts.output + '.txt', 'a')
+    writeStreamOutput(resultqueue, outfile, reader, processes, options, copts)
+    if copts.stdout: outfile.flush()
+    else: outfile.close()
+    reader.join()
+    for process in processes: process.join()
 
-# Merging tmp files
-if copts.threads > 1: mergeTmpFiles(copts.output, options.args['outputformat'], copts.threads)
+else:
+    # Initializing annotation processes
+    threadidx = 0
+    processes = []
+    for shard in breaks:
+        threadidx += 1
+        processes.append(
+            SingleJob(threadidx, options, copts, shard, genelist, transcriptlist, snplist, impactdir, numOfRecords))
+
+    # Running annotation processes
+    for process in processes: process.start()
+    for process in processes: process.join()
+
+    # Merging tmp files
+    if copts.threads > 1: mergeTmpFiles(copts.output, options.args['outputformat'], copts.threads)
 
 # Printing out summary information and end time
 if not copts.stdout: printEndInfo(options, copts, starttime)
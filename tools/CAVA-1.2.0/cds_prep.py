@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+
+# Coding sequence database preparation tool (cds_prep)
+#######################################################################################################################
+
+# Basic imports
+import os
+import sys
+import gzip
+import datetime
+from optparse import OptionParser
+
+if sys.version_info[0] == 3:
+    print '\nCAVA does not run on Python 3.\n'
+    quit()
+
+# Imports of CAVA code
+import core
+from data import Reference
+
+
+#######################################################################################################################
+
+# Class providing the reference genome file name in the form expected by data.Reference
+class ReferenceOptions(object):
+    # Constructor
+    def __init__(self, reference):
+        self.args = {'reference': reference}
+
+
+# Process transcript database file
+def processData(options, reference):
+    outfile = open(options.output + '.cds', 'w')
+    indexfile = open(options.output + '.cds.idx', 'w')
+    indexfile.write('# Created by cds_prep based on ' + os.path.basename(options.ensembl) + ' and ' + os.path.basename(options.reference) + '\n')
+    # Size and modification time of the source files, checked by CAVA against the @ensembl and @reference files used
+    for name, fn in [('ensembl', options.ensembl), ('reference', options.reference)]:
+        indexfile.write('#source\t' + name + '\t' + '\t'.join(str(x) for x in core.cdsSource(fn)) + '\n')
+
+    counter = 0
+    skipped = 0
+    chrom_proc = ''
+    for line in gzip.open(options.ensembl, 'r'):
+        line = line.rstrip('\n')
+        if line == '' or line.startswith('#'): continue
+
+        transcript = core.Transcript(line, reference)
+        if transcript.chrom != chrom_proc:
+            chrom_proc = transcript.chrom
+            sys.stdout.write('\rProcessing transcripts on chr' + chrom_proc + ' ...  ')
+            sys.stdout.flush()
+
+        # Skipping transcripts on contigs not present in the reference genome
+        if reference.getReference(transcript.chrom, 1, 1) is None:
+            skipped += 1
+            continue
+
+        # Exon sequences (in transcript orientation) and translated reference coding sequence
+        try:
+            protein, exonseqs = transcript.getProteinSequence(reference, None, None)
+        except KeyError:
+            skipped += 1
+            continue
+
+        record = '\t'.join([transcript.TRANSCRIPT, protein, ','.join([str(len(x)) for x in exonseqs]), ''.join(exonseqs)]) + '\n'
+        indexfile.write(transcript.TRANSCRIPT + '\t' + str(outfile.tell()) + '\t' + str(len(record)) + '\n')
+        outfile.write(record)
+        counter += 1
+
+    sys.stdout.write('\rProcessing transcripts on all chrs ... OK')
+    sys.stdout.flush()
+    print ''
+    outfile.close()
+    indexfile.close()
+    return counter, skipped
+
+
+#######################################################################################################################
+
+
+if __name__ == '__main__':
+
+    # Version number
+    ver = 'v1.2.0'
+
+    # Command line argument parsing
+    descr = 'Coding sequence database preparation tool (cds_prep) for CAVA ' + ver + '. Creates the database used via the @cdsdb option flag.'
+    epilog = '\nExample usage: ./cds_prep.py -e ensembl75s.gz -r hg19.fa -o ensembl75s\n\n'
+    OptionParser.format_epilog = lambda self, formatter: self.epilog
+    parser = OptionParser(usage='python path/to/cava/cds_prep.py <options>', version=ver, description=descr, epilog=epilog)
+    parser.add_option('-e', "--ensembl", default=None, dest='ensembl', action='store', help="Transcript database file (as used via @ensembl)")
+    parser.add_option('-r', "--reference", default=None, dest='reference', action='store', help="Reference genome file (as used via @reference)")
+    parser.add_option('-o', "--out", default='output', dest='output', action='store', help="Output filename prefix")
+    (options, args) = parser.parse_args()
+
+    # Check options
+    if options.ensembl is None or not os.path.isfile(options.ensembl):
+        print '\nError: transcript database file not found'
+        print 'Please use option -e to specify the transcript database file\n'
+        quit()
+    if options.reference is None or not os.path.isfile(options.reference + '.fai'):
+        print '\nError: reference genome file (with .fa.fai index) not found'
+        print 'Please use option -r to specify the reference genome file\n'
+        quit()
+
+    # Print out version information
+    print "\n---------------------------------------------------------------------------------------"
+    print 'CAVA ' + ver + ' coding sequence database preparation tool (cds_prep) is now running.'
+    print 'Started: ', datetime.datetime.now(), '\n'
+
+    # Create output files
+    N, skipped = processData(options, Reference(ReferenceOptions(options.reference)))
+
+    # Print out summary information
+    print '\nA total of ' + str(N) + ' transcripts have been processed'
+    if skipped > 0: print str(skipped) + ' transcripts skipped (contig not in the reference genome or non-ACGTN bases in the coding sequence)'
+    print ''
+    print '---------------------'
+    print 'Output files created:'
+    print '---------------------'
+    print options.output + '.cds (coding sequence database)'
+    print options.output + '.cds.idx (index file)'
+    print ''
+    print 'CAVA cds_prep successfully finished: ', datetime.datetime.now()
+    print "---------------------------------------------------------------------------------------\n"
+
+#######################################################################################################################
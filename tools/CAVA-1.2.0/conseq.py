@@ -4,6 +4,9 @@
 # CLASS annotation
 #######################################################################################################################
 
+import core
+
+
 # Getting CLASS annotation of a given variant
 def getClassAnnotation(variant, transcript, protein, mutprotein, loc, ssrange):
     # Variants in UTR
@@ -44,24 +47,18 @@ def getClassAnnotation(variant, transcript, protein, mutprotein, loc, ssrange):
     if protein[0] != mutprotein[0]: return 'IM'
 
     # Stop gain and stop lost variants
-    while len(protein) > 0 and len(mutprotein) > 0:
-        if protein[0] == mutprotein[0]:
-            protein = protein[1:]
-            mutprotein = mutprotein[1:]
-        else:
-            break
+    common = core.commonPrefixLength(protein, mutprotein, min(len(protein), len(mutprotein)))
+    protein = protein[common:]
+    mutprotein = mutprotein[common:]
 
     if protein == '': return '3PU'
 
     if protein[0] == 'X' and len(mutprotein) == 0: return 'SL'
     if protein[0] == 'X' and mutprotein[0] != 'X': return 'SL'
 
-    while len(protein) > 0 and len(mutprotein) > 0:
-        if protein[-1] == mutprotein[-1]:
-            protein = protein[:-1]
-            mutprotein = mutprotein[:-1]
-        else:
-            break
+    common = core.commonSuffixLength(protein, mutprotein, min(len(protein), len(mutprotein)))
+    protein = protein[:len(protein) - common]
+    mutprotein = mutprotein[:len(mutprotein) - common]
 
     if 'X' in mutprotein: return 'SG'
 
@@ -137,12 +134,9 @@ def getSequenceOntologyAnnotation(variant, transcript, protein, mutprotein, loc)
 
     if (not protein == mutprotein) and len(protein) == len(mutprotein): out.append('missense_variant')
 
-    while len(protein) > 0 and len(mutprotein) > 0:
-        if protein[0] == mutprotein[0]:
-            protein = protein[1:]
-            mutprotein = mutprotein[1:]
-        else:
-            break
+    common = core.commonPrefixLength(protein, mutprotein, min(len(protein), len(mutprotein)))
+    protein = protein[common:]
+    mutprotein = mutprotein[common:]
 
     if protein == '': return '3_prime_UTR_variant'
 
@@ -150,12 +144,9 @@ def getSequenceOntologyAnnotation(variant, transcript, protein, mutprotein, loc)
     else:
         if protein[0] == 'X' and mutprotein[0] != 'X': out.append('stop_lost')
 
-    while len(protein) > 0 and len(mutprotein) > 0:
-        if protein[-1] == mutprotein[-1]:
-            protein = protein[:-1]
-            mutprotein = mutprotein[:-1]
-        else:
-            break
+    common = core.commonSuffixLength(protein, mutprotein, min(len(protein), len(mutprotein)))
+    protein = protein[:len(protein) - common]
+    mutprotein = mutprotein[:len(mutprotein) - common]
 
     if 'X' in mutprotein: out.append('stop_gained')
 
@@ -8,8 +8,10 @@
 from __future__ import division
 import os
 import logging
-import gzip
 import time
+import bisect
+import string
+import re
 
 
 #######################################################################################################################
@@ -126,33 +128,45 @@ class Variant(object):
 
     # Right-aligning two sequences
     def rightAlign(self, seq1, seq2):
-        left, seq1, seq2 = self.trimCommonStart(seq1, seq2)
-        right, seq1, seq2 = self.trimCommonEnd(seq1, seq2)
-        return left, seq1, seq2
+        left = commonPrefixLength(seq1, seq2, min(len(seq1), len(seq2)))
+        right = commonSuffixLength(seq1, seq2, min(len(seq1), len(seq2)) - left)
+        return left, seq1[left:len(seq1) - right], seq2[left:len(seq2) - right]
 
     # Left-aligning two sequences
     def leftAlign(self, seq1, seq2):
-        right, seq1, seq2 = self.trimCommonEnd(seq1, seq2)
-        left, seq1, seq2 = self.trimCommonStart(seq1, seq2)
-        return left, seq1, seq2
+        right = commonSuffixLength(seq1, seq2, min(len(seq1), len(seq2)))
+        left = commonPrefixLength(seq1, seq2, min(len(seq1), len(seq2)) - right)
+        return left, seq1[left:len(seq1) - right], seq2[left:len(seq2) - right]
 
     # Trimming common starting subsequence of two sequences
     def trimCommonStart(self, s1, s2):
-        counter = 0
-        while True:
-            if len(s1) == 0 or len(s2) == 0: return counter, s1, s2
-            if s1[0] != s2[0]: return counter, s1, s2
-            s1, s2 = s1[1:], s2[1:]
-            counter += 1
+        counter = commonPrefixLength(s1, s2, min(len(s1), len(s2)))
+        if counter == 0: return counter, s1, s2
+        return counter, s1[counter:], s2[counter:]
 
     # Trimming common ending subsequence of two sequences
     def trimCommonEnd(self, s1, s2):
-        counter = 0
-        while True:
-            if len(s1) == 0 or len(s2) == 0: return counter, s1, s2
-            if s1[-1] != s2[-1]: return counter, s1, s2
-            s1, s2 = s1[:-1], s2[:-1]
-            counter += 1
+        counter = commonSuffixLength(s1, s2, min(len(s1), len(s2)))
+        if counter == 0: return counter, s1, s2
+        return counter, s1[:len(s1) - counter], s2[:len(s2) - counter]
+
+
+# Getting the length of the common starting subsequence of two sequences (not longer than maxlen)
+def commonPrefixLength(s1, s2, maxlen):
+    ret = 0
+    while ret + 64 <= maxlen and s1[ret:ret + 64] == s2[ret:ret + 64]: ret += 64
+    while ret < maxlen and s1[ret] == s2[ret]: ret += 1
+    return ret
+
+
+# Getting the length of the common ending subsequence of two sequences (not longer than maxlen)
+def commonSuffixLength(s1, s2, maxlen):
+    n1 = len(s1)
+    n2 = len(s2)
+    ret = 0
+    while ret + 64 <= maxlen and s1[n1 - ret - 64:n1 - ret] == s2[n2 - ret - 64:n2 - ret]: ret += 64
+    while ret < maxlen and s1[n1 - ret - 1] == s2[n2 - ret - 1]: ret += 1
+    return ret
 
 
 #######################################################################################################################
@@ -454,6 +468,58 @@ class Transcript(object):
         ret = Sequence(codingsequence).translate(1)
         return ret, exonseqa
 
+    # Getting the translated protein sequence of the transcript with a variant by retranslating only the affected codons
+    # (reference protein and exon sequences are needed; None is returned if the variant changes the 5' of the coding start)
+    def getMutantProteinSequence(self, variant, protein, exonseqs):
+        # Finding the exon affected by the variant (as in getCodingSequence) and its offset in the transcript
+        idx = None
+        offsets = [0]
+        for i in range(len(self.exons)):
+            if idx is None and self.exons[i].start < variant.pos <= self.exons[i].end: idx = i
+            offsets.append(offsets[-1] + len(exonseqs[i]))
+        if idx is None: return protein
+        exon = self.exons[idx]
+        if not len(exonseqs[idx]) == exon.length: return None
+
+        # Part of the exon sequence replaced by the variant (in transcript orientation)
+        left = variant.pos - 1 - exon.start
+        right = max(0, exon.end - (variant.pos + len(variant.ref)) + 1)
+        if self.strand == 1:
+            start, end, ins = left, exon.length - right, variant.alt
+        else:
+            start, end, ins = right, exon.length - left, Sequence(variant.alt).reverseComplement()
+
+        # Replaced part in coding sequence coordinates
+        c0 = self.codingStart - 1
+        cstart = offsets[idx] + start - c0
+        cend = offsets[idx] + end - c0
+        cdslength = offsets[-1] - c0
+        if cstart < 0: return None
+        first = cstart // 3
+
+        # In-frame changes: only the codons overlapping with the replaced part are translated
+        if (len(ins) - (cend - cstart)) % 3 == 0:
+            last = -(-cend // 3)
+            if last * 3 <= cdslength:
+                window = sliceExonSequences(exonseqs, offsets, c0 + first * 3, c0 + cstart) + ins + sliceExonSequences(exonseqs, offsets, c0 + cend, c0 + last * 3)
+                return protein[:first] + Sequence(window).translate(1) + protein[last:]
+            window = sliceExonSequences(exonseqs, offsets, c0 + first * 3, c0 + cstart) + ins + sliceExonSequences(exonseqs, offsets, c0 + cend, offsets[-1])
+            return protein[:first] + Sequence(window).translate(1)
+
+        # Frameshifts: translating until the first stop codon after the first changed amino acid (only the sequence up
+        # to this point is used by annotations of frameshift variants), or to the end of the transcript otherwise
+        suffix = sliceExonSequences(exonseqs, offsets, c0 + first * 3, c0 + cstart) + ins + sliceExonSequences(exonseqs, offsets, c0 + cend, offsets[-1])
+        ret = [protein[:first]]
+        j = first
+        changed = False
+        for k in range(0, len(suffix), 90):
+            for aa in Sequence(suffix[k:k + 90]).translate(1):
+                if not changed and (j >= len(protein) or not aa == protein[j]): changed = True
+                ret.append(aa)
+                j += 1
+                if changed and aa == 'X' and not variant.isInFrame(): return ''.join(ret)
+        return ''.join(ret)
+
     # Checking if a given position is outside the region between the start and stop codon
     def isPositionOutsideCDS(self, pos):
         if self.strand == 1:
@@ -614,6 +680,26 @@ class Transcript(object):
                 prev = exon.start
 
 
+# Getting a part of the concatenated exon sequences (offsets are the start positions of exons in the transcript)
+def sliceExonSequences(exonseqs, offsets, start, end):
+    ret = []
+    i = bisect.bisect_right(offsets, start) - 1
+    while i < len(exonseqs) and offsets[i] < end:
+        ret.append(exonseqs[i][max(0, start - offsets[i]):end - offsets[i]])
+        i += 1
+    return ''.join(ret)
+
+
+# Creating a transcript object from already parsed database values (info tuple and exon start and end coordinates)
+def makeTranscript(chrom, info, exonstarts, exonends):
+    ret = Transcript.__new__(Transcript)
+    ret.TRANSCRIPT, ret.geneSymbol, ret.geneID, ret.TRINFO, ret.strand, ret.transcriptStart, ret.transcriptEnd, \
+        ret.codingStart, ret.codingStartGenomic, ret.codingEndGenomic = info
+    ret.chrom = chrom
+    ret.exons = [Exon(i + 1, exonstarts[i], exonends[i]) for i in range(len(exonstarts))]
+    return ret
+
+
 #######################################################################################################################
 
 # Class representing a single exon
@@ -635,61 +721,73 @@ class Exon(object):
 class Sequence(str):
     # Translating to amino acid sequence
     def translate(self, letter):
-        if letter == 1:
-            gencode = {
-                'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
-                'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
-                'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
-                'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
-                'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
-                'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
-                'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
-                'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
-                'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
-                'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
-                'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
-                'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
-                'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
-                'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
-                'TAC': 'Y', 'TAT': 'Y', 'TAA': 'X', 'TAG': 'X',
-                'TGC': 'C', 'TGT': 'C', 'TGA': 'X', 'TGG': 'W'}
-        if letter == 3:
-            gencode = {
-                'ATA': 'Ile', 'ATC': 'Ile', 'ATT': 'Ile', 'ATG': 'Met',
-                'ACA': 'Thr', 'ACC': 'Thr', 'ACG': 'Thr', 'ACT': 'Thr',
-                'AAC': 'Asn', 'AAT': 'Asn', 'AAA': 'Lys', 'AAG': 'Lys',
-                'AGC': 'Ser', 'AGT': 'Ser', 'AGA': 'Arg', 'AGG': 'Arg',
-                'CTA': 'Leu', 'CTC': 'Leu', 'CTG': 'Leu', 'CTT': 'Leu',
-                'CCA': 'Pro', 'CCC': 'Pro', 'CCG': 'Pro', 'CCT': 'Pro',
-                'CAC': 'His', 'CAT': 'His', 'CAA': 'Gln', 'CAG': 'Gln',
-                'CGA': 'Arg', 'CGC': 'Arg', 'CGG': 'Arg', 'CGT': 'Arg',
-                'GTA': 'Val', 'GTC': 'Val', 'GTG': 'Val', 'GTT': 'Val',
-                'GCA': 'Ala', 'GCC': 'Ala', 'GCG': 'Ala', 'GCT': 'Ala',
-                'GAC': 'Asp', 'GAT': 'Asp', 'GAA': 'Glu', 'GAG': 'Glu',
-                'GGA': 'Gly', 'GGC': 'Gly', 'GGG': 'Gly', 'GGT': 'Gly',
-                'TCA': 'Ser', 'TCC': 'Ser', 'TCG': 'Ser', 'TCT': 'Ser',
-                'TTC': 'Phe', 'TTT': 'Phe', 'TTA': 'Leu', 'TTG': 'Leu',
-                'TAC': 'Tyr', 'TAT': 'Tyr', 'TAA': 'X', 'TAG': 'X',
-                'TGC': 'Cys', 'TGT': 'Cys', 'TGA': 'X', 'TGG': 'Trp'}
-        ret = ''
-        index = 0
-        while index + 3 <= len(self):
-            codon = self[index:index + 3].upper()
-            if 'N' in codon:
-                ret += '?'
-                index += 3
-                continue
-            ret += gencode[codon]
-            index += 3
-        return ret
+        if letter == 1: gencode = gencode1
+        if letter == 3: gencode = gencode3
+        seq = self.upper()
+        try:
+            return ''.join(map(gencode.__getitem__, codonPattern.findall(seq)))
+        except KeyError:
+            # Codons with bases other than ACGTN: only codons containing N are translated (as ?)
+            ret = ''
+            for i in xrange(0, len(seq) - 2, 3):
+                codon = seq[i:i + 3]
+                if 'N' in codon: ret += '?'
+                else: ret += gencode[codon]
+            return ret
 
     # Getting reverse complement sequence
     def reverseComplement(self):
-        complement = {"A": "T", "T": "A", "C": "G", "G": "C", "N": "N", "a": "t", "t": "a", "c": "g", "g": "c",
-                      "n": "n"}
-        ret = ''
-        for base in self[::-1]: ret += complement[base]
-        return ret
+        return str.translate(self, complement)[::-1]
+
+
+# Genetic code with 1-letter and 3-letter amino acid codes (codons with N are translated as ?)
+gencode1 = {
+    'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
+    'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
+    'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
+    'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
+    'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
+    'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
+    'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
+    'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
+    'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
+    'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
+    'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
+    'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
+    'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
+    'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
+    'TAC': 'Y', 'TAT': 'Y', 'TAA': 'X', 'TAG': 'X',
+    'TGC': 'C', 'TGT': 'C', 'TGA': 'X', 'TGG': 'W'}
+gencode3 = {
+    'ATA': 'Ile', 'ATC': 'Ile', 'ATT': 'Ile', 'ATG': 'Met',
+    'ACA': 'Thr', 'ACC': 'Thr', 'ACG': 'Thr', 'ACT': 'Thr',
+    'AAC': 'Asn', 'AAT': 'Asn', 'AAA': 'Lys', 'AAG': 'Lys',
+    'AGC': 'Ser', 'AGT': 'Ser', 'AGA': 'Arg', 'AGG': 'Arg',
+    'CTA': 'Leu', 'CTC': 'Leu', 'CTG': 'Leu', 'CTT': 'Leu',
+    'CCA': 'Pro', 'CCC': 'Pro', 'CCG': 'Pro', 'CCT': 'Pro',
+    'CAC': 'His', 'CAT': 'His', 'CAA': 'Gln', 'CAG': 'Gln',
+    'CGA': 'Arg', 'CGC': 'Arg', 'CGG': 'Arg', 'CGT': 'Arg',
+    'GTA': 'Val', 'GTC': 'Val', 'GTG': 'Val', 'GTT': 'Val',
+    'GCA': 'Ala', 'GCC': 'Ala', 'GCG': 'Ala', 'GCT': 'Ala',
+    'GAC': 'Asp', 'GAT': 'Asp', 'GAA': 'Glu', 'GAG': 'Glu',
+    'GGA': 'Gly', 'GGC': 'Gly', 'GGG': 'Gly', 'GGT': 'Gly',
+    'TCA': 'Ser', 'TCC': 'Ser', 'TCG': 'Ser', 'TCT': 'Ser',
+    'TTC': 'Phe', 'TTT': 'Phe', 'TTA': 'Leu', 'TTG': 'Leu',
+    'TAC': 'Tyr', 'TAT': 'Tyr', 'TAA': 'X', 'TAG': 'X',
+    'TGC': 'Cys', 'TGT': 'Cys', 'TGA': 'X', 'TGG': 'Trp'}
+
+# Codons containing N (translated as ?)
+def unknownCodons():
+    return dict((x + y + z, '?') for x in 'ACGTN' for y in 'ACGTN' for z in 'ACGTN' if 'N' in x + y + z)
+
+gencode1.update(unknownCodons())
+gencode3.update(unknownCodons())
+
+# Pattern splitting a sequence to codons
+codonPattern = re.compile('...')
+
+# Complement bases (translation table)
+complement = string.maketrans('ATCGNatcgn', 'TAGCNtagcn')
 
 
 #######################################################################################################################
@@ -721,6 +819,10 @@ class Options(object):
         self.defs['ontology'] = ('string', 'both')
         self.defs['impactdef'] = ('string', 'SG,ESS,FS|SS5,IM,SL,EE,IF,NSY|SY,SS,INT,5PU,3PU')
         self.defs['prefix'] = ('boolean', False)
+        self.defs['cachesize'] = ('string', '64')
+        self.defs['cachebytes'] = ('string', '0')
+        self.defs['transcriptstore'] = ('boolean', True)
+        self.defs['cdsdb'] = ('string', '.')
 
 
         # Reading options from file
@@ -839,17 +941,21 @@ def writeHeader(options, header, outfile, stdout):
             outfile.write(str + '\n')
 
 
-# Counting number of records in a file
-def countRecords(filename):
-    ret = 0
-    if filename.endswith('.gz'):
-        inputf = gzip.open(filename, 'r')
-    else:
-        inputf = open(filename)
-    for line in inputf:
-        line = line.strip()
-        if not (line.startswith("#") or line == ''): ret += 1
-    return ret
+# Size and modification time of a source file of the coding sequence database (as recorded in its .idx header)
+def cdsSource(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, int(stat.st_mtime))
+
+
+# Checking if the coding sequence database was created from the given transcript database and reference genome files
+def cdsDatabaseMatches(cdsdb, ensembl, reference):
+    sources = dict()
+    for line in open(cdsdb + '.idx'):
+        if not line.startswith('#'): break
+        cols = line.rstrip('\n').split('\t')
+        if cols[0] == '#source' and len(cols) == 4: sources[cols[1]] = (int(cols[2]), int(cols[3]))
+    if not os.path.isfile(ensembl) or not os.path.isfile(reference): return False
+    return sources.get('ensembl') == cdsSource(ensembl) and sources.get('reference') == cdsSource(reference)
 
 
 # Checking if options are correct
@@ -903,6 +1009,26 @@ def checkOptions(options):
             logging.info('No output file written. CAVA quit.')
         quit()
 
+    # Checking if @cachesize and @cachebytes were given correct values
+    if not (options.args['cachesize'].isdigit() and int(options.args['cachesize']) >= 1):
+        print 'ERROR: incorrect value of the tag @cachesize.'
+        print '(Minimum value allowed is 1.)'
+        print '\nNo output file written. CAVA quit.'
+        print "--------------------------------------------------------------------\n"
+        if options.args['logfile']:
+            logging.error('Incorrect value of the tag @cachesize.')
+            logging.info('No output file written. CAVA quit.')
+        quit()
+    if not options.args['cachebytes'].isdigit():
+        print 'ERROR: incorrect value of the tag @cachebytes.'
+        print '(Allowed values: non-negative integer, 0 meaning no limit)'
+        print '\nNo output file written. CAVA quit.'
+        print "--------------------------------------------------------------------\n"
+        if options.args['logfile']:
+            logging.error('Incorrect value of the tag @cachebytes.')
+            logging.info('No output file written. CAVA quit.')
+        quit()
+
     # Checking if @ontology was given correct value
     str = options.args['ontology'].upper()
     if not (str == 'CLASS' or str == 'SO' or str == 'BOTH'):
@@ -957,6 +1083,29 @@ def checkOptions(options):
             logging.info('No output file written. CAVA quit.')
         quit()
 
+    # Checking if @cdsdb file and its index file exist
+    if not (options.args['cdsdb'] == '.' or options.args['cdsdb'] == '') and not (os.path.isfile(
+            options.args['cdsdb']) and os.path.isfile(options.args['cdsdb'] + '.idx')):
+        print 'ERROR: the file given as @cdsdb or its .cds.idx index file does not exist.'
+        print '\nNo output file written. CAVA quit.'
+        print "--------------------------------------------------------------------\n"
+        if options.args['logfile']:
+            logging.error('The file given as @cdsdb or its .cds.idx index file does not exist.')
+            logging.info('No output file written. CAVA quit.')
+        quit()
+
+    # Checking if @cdsdb was created from the @ensembl and @reference files given (by their size and modification time)
+    if not (options.args['cdsdb'] == '.' or options.args['cdsdb'] == '') and not cdsDatabaseMatches(
+            options.args['cdsdb'], options.args['ensembl'], options.args['reference']):
+        print 'ERROR: the file given as @cdsdb was not created from the @ensembl and @reference files given.'
+        print '(Please recreate it with cds_prep)'
+        print '\nNo output file written. CAVA quit.'
+        print "--------------------------------------------------------------------\n"
+        if options.args['logfile']:
+            logging.error('The file given as @cdsdb was not created from the @ensembl and @reference files given.')
+            logging.info('No output file written. CAVA quit.')
+        quit()
+
     # Checking if @dbsnp file exists
     if not (options.args['dbsnp'] == '.' or options.args['dbsnp'] == '') and not os.path.isfile(options.args['dbsnp']):
         print 'ERROR: the file given as @dbsnp does not exist.'
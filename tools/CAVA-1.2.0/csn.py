@@ -183,15 +183,11 @@ def makeProteinString(variant, transcript, reference, prot, mutprot, coord1):
     if prot[0] != mutprot[0]: return '_p.' + changeTo3letters(prot[0]) + '1?', ('1', prot[0], mutprot[0])
 
     # Trimming common starting substring
-    leftindex = 1
+    common = core.commonPrefixLength(prot, mutprot, min(len(prot), len(mutprot)))
+    leftindex = 1 + common
     rightindex = len(prot)
-    while len(prot) > 0 and len(mutprot) > 0:
-        if prot[0] == mutprot[0]:
-            prot = prot[1:]
-            mutprot = mutprot[1:]
-            leftindex += 1
-        else:
-            break
+    prot = prot[common:]
+    mutprot = mutprot[common:]
 
     if prot == '': return '', ('.','.','.')
 
@@ -212,13 +208,10 @@ def makeProteinString(variant, transcript, reference, prot, mutprot, coord1):
             return '_p.X' + str(leftindex) + changeTo3letters(mutprot[0]) + 'extX?', (str(leftindex), 'X', mutprot[0])
 
     # Trimming common ending substring
-    while len(prot) > 0 and len(mutprot) > 0:
-        if prot[-1] == mutprot[-1]:
-            prot = prot[:-1]
-            mutprot = mutprot[:-1]
-            rightindex -= 1
-        else:
-            break
+    common = core.commonSuffixLength(prot, mutprot, min(len(prot), len(mutprot)))
+    rightindex -= common
+    prot = prot[:len(prot) - common]
+    mutprot = mutprot[:len(mutprot) - common]
 
     # Checking if variant results in an amino acid change
     if len(prot) == 1 and len(mutprot) == 1: return '_p.' + changeTo3letters(prot) + str(leftindex) + changeTo3letters(
@@ -5,6 +5,11 @@
 #######################################################################################################################
 
 import sys, os
+import gzip
+import bisect
+import cPickle
+from array import array
+from collections import OrderedDict
 import core
 import csn
 import conseq
@@ -20,10 +25,21 @@ class Ensembl(object):
     # Constructor
     def __init__(self, options, genelist, transcriptlist):
         self.options = options
-        # Openning tabix file representing the Ensembl database
-        self.tabixfile = pysam.Tabixfile(options.args['ensembl'])
-        self.proteinSeqs = dict()
-        self.exonSeqs = dict()
+        # Using the precompiled transcript store or openning tabix file representing the Ensembl database
+        if options.args['transcriptstore']:
+            self.store = loadTranscriptStore(options.args['ensembl'])
+            self.contigs = self.store.contigs
+        else:
+            self.store = None
+            self.tabixfile = pysam.Tabixfile(options.args['ensembl'])
+            self.contigs = self.tabixfile.contigs
+        # Cache of protein and exon sequences of recently used transcripts
+        self.seqCache = LRUCache(int(options.args['cachesize']), int(options.args['cachebytes']))
+        # Prebuilt reference protein and exon sequences, if available
+        if not (options.args['cdsdb'] == '.' or options.args['cdsdb'] == ''):
+            self.cdsdb = loadCDSDatabase(options.args['cdsdb'])
+        else:
+            self.cdsdb = None
         self.genelist = genelist
         self.transcriptlist = transcriptlist
 
@@ -34,9 +50,9 @@ class Ensembl(object):
 
         # Checking chromosome name
         goodchrom = variant.chrom
-        if not goodchrom in self.tabixfile.contigs:
+        if not goodchrom in self.contigs:
             goodchrom = 'chr' + goodchrom
-            if not goodchrom in self.tabixfile.contigs: return ret, retOUT
+            if not goodchrom in self.contigs: return ret, retOUT
 
         # Defining variant end points
         if not variant.isInsertion():
@@ -47,21 +63,16 @@ class Ensembl(object):
             end = variant.pos
 
         # Checking both end points of the variant
-        reg1 = goodchrom + ':' + str(start) + '-' + str(start)
-        reg2 = goodchrom + ':' + str(end) + '-' + str(end)
-
         if not variant.isSubstitution():
-            hits1 = self.tabixfile.fetch(region=reg1)
-            hits2 = self.tabixfile.fetch(region=reg2)
+            hits1 = self.fetchTranscripts(goodchrom, start, reference)
+            hits2 = self.fetchTranscripts(goodchrom, end, reference)
             hitdict1 = dict()
             hitdict2 = dict()
-            for line in hits1:
-                transcript = core.Transcript(line, reference)
+            for transcript in hits1:
                 if not (transcript.transcriptStart + 1 <= start <= transcript.transcriptEnd): continue
                # if not strand == transcript.strand: continue
                 hitdict1[transcript.TRANSCRIPT] = transcript
-            for line in hits2:
-                transcript = core.Transcript(line, reference)
+            for transcript in hits2:
                 if not (transcript.transcriptStart + 1 <= end <= transcript.transcriptEnd): continue
               #  if not strand == transcript.strand: continue
                 hitdict2[transcript.TRANSCRIPT] = transcript
@@ -86,9 +97,8 @@ class Ensembl(object):
                         retOUT[key] = transcript
 
         else:
-            hits1 = self.tabixfile.fetch(region=reg2)
-            for line in hits1:
-                transcript = core.Transcript(line, reference)
+            hits1 = self.fetchTranscripts(goodchrom, end, reference)
+            for transcript in hits1:
 
                 if len(self.genelist) > 0 and transcript.geneSymbol not in self.genelist: continue
                 if len(self.transcriptlist) > 0 and transcript.TRANSCRIPT not in self.transcriptlist: continue
@@ -98,6 +108,12 @@ class Ensembl(object):
 
         return ret, retOUT
 
+    # Getting transcripts that may overlap with a given position (from the transcript store or the tabix file)
+    def fetchTranscripts(self, chrom, pos, reference):
+        if self.store is not None: return self.store.findTranscripts(chrom, pos)
+        reg = chrom + ':' + str(pos) + '-' + str(pos)
+        return [core.Transcript(line, reference) for line in self.tabixfile.fetch(region=reg)]
+
     # Check if a is between x and y
     def inrange(self, x, y, a):
         return x <= a <= y or y <= a <= x
@@ -297,29 +313,26 @@ class Ensembl(object):
             if notexonic_plus and notexonic_minus:
                 protein = ''
             else:
-                if not transcript.TRANSCRIPT in self.proteinSeqs.keys():
-                    protein, exonseqs = transcript.getProteinSequence(reference, None, None)
-
-                    if len(self.proteinSeqs) > 5:
-                        self.proteinSeqs = dict()
-                        self.exonSeqs = dict()
-
-                    self.proteinSeqs[transcript.TRANSCRIPT] = protein
-                    self.exonSeqs[transcript.TRANSCRIPT] = exonseqs
-                else:
-                    protein = self.proteinSeqs[transcript.TRANSCRIPT]
-                    exonseqs = self.exonSeqs[transcript.TRANSCRIPT]
+                cached = self.seqCache.get(transcript.TRANSCRIPT)
+                if cached is None:
+                    if self.cdsdb is not None: cached = self.cdsdb.getSequences(transcript.TRANSCRIPT)
+                    if cached is None: cached = transcript.getProteinSequence(reference, None, None)
+                    size = len(cached[0]) + sum([len(x) for x in cached[1]])
+                    self.seqCache.put(transcript.TRANSCRIPT, cached, size)
+                protein, exonseqs = cached
 
             if notexonic_plus:
                 mutprotein_plus = ''
             else:
-                mutprotein_plus, exonseqs = transcript.getProteinSequence(reference, variant_plus, exonseqs)
+                mutprotein_plus = transcript.getMutantProteinSequence(variant_plus, protein, exonseqs)
+                if mutprotein_plus is None: mutprotein_plus, exonseqs = transcript.getProteinSequence(reference, variant_plus, exonseqs)
 
             if difference:
                 if notexonic_minus:
                     mutprotein_minus = ''
                 else:
-                    mutprotein_minus, exonseqs = transcript.getProteinSequence(reference, variant_minus, exonseqs)
+                    mutprotein_minus = transcript.getMutantProteinSequence(variant_minus, protein, exonseqs)
+                    if mutprotein_minus is None: mutprotein_minus, exonseqs = transcript.getProteinSequence(reference, variant_minus, exonseqs)
             else:
                 mutprotein_minus = mutprotein_plus
 
@@ -530,10 +543,20 @@ class Reference(object):
     def __init__(self, options):
         # Openning tabix file representing the reference genome
         self.fastafile = pysam.Fastafile(options.args['reference'])
-
-    # Retrieving the sequence of a genomic region    
-    def getReference(self, chrom, start, end):
-        # Checking if chromosome name exists
+        self.useOldAPI = pysam.__version__ in ['0.7.7', '0.7.8', '0.8.0']
+        # Resolved name and length of each requested chromosome (None if not in the reference genome)
+        self.contigs = dict()
+        # Recently used pages of the reference genome
+        self.pageSize = 65536
+        self.pages = LRUCache(64, 0)
+        self.currentKey = None
+        self.currentPage = None
+        self.requests = 0
+        self.fetches = 0
+        self.hits = 0
+
+    # Resolving the chromosome name used in the reference genome and the chromosome length
+    def resolveContig(self, chrom):
         goodchrom = chrom
         if not goodchrom in self.fastafile.references:
             goodchrom = 'chr' + chrom
@@ -544,17 +567,254 @@ class Reference(object):
                 else:
                     return None
 
-                # Fetching data from reference genome
+        if self.useOldAPI:
+            return goodchrom, self.fastafile.getReferenceLength(goodchrom)
+        else:
+            return goodchrom, self.fastafile.get_reference_length(goodchrom)
+
+    # Retrieving the sequence of a genomic region    
+    def getReference(self, chrom, start, end):
+        # Checking if chromosome name exists
+        if not chrom in self.contigs: self.contigs[chrom] = self.resolveContig(chrom)
+        if self.contigs[chrom] is None: return None
+        goodchrom, last = self.contigs[chrom]
+
+        # Fetching data from reference genome
         if end < start: return core.Sequence('')
         if start < 1: start = 1
-
-        if pysam.__version__ in ['0.7.7', '0.7.8', '0.8.0']:
-            last = self.fastafile.getReferenceLength(goodchrom)
+        if end > last: end = last
+        if end < start: return core.Sequence('')
+        self.requests += 1
+
+        # Large regions are fetched directly, others are served from the pages they overlap with
+        first = (start - 1) // self.pageSize
+        lastpage = (end - 1) // self.pageSize
+        if lastpage - first > 3:
+            self.fetches += 1
+            return core.Sequence(self.fastafile.fetch(goodchrom, start - 1, end).upper())
+        if first == lastpage:
+            offset = first * self.pageSize
+            return core.Sequence(self.getPage(goodchrom, first, last)[start - 1 - offset:end - offset])
+        ret = []
+        for p in range(first, lastpage + 1):
+            offset = p * self.pageSize
+            ret.append(self.getPage(goodchrom, p, last)[max(0, start - 1 - offset):end - offset])
+        return core.Sequence(''.join(ret))
+
+    # Getting a page of the reference genome (i.e. the p-th block of pageSize bases of the chromosome)
+    def getPage(self, goodchrom, p, last):
+        key = (goodchrom, p)
+        if key == self.currentKey:
+            self.hits += 1
+            return self.currentPage
+        ret = self.pages.get(key)
+        if ret is None:
+            self.fetches += 1
+            ret = self.fastafile.fetch(goodchrom, p * self.pageSize, min((p + 1) * self.pageSize, last)).upper()
+            self.pages.put(key, ret, len(ret))
         else:
-            last = self.fastafile.get_reference_length(goodchrom)
+            self.hits += 1
+        self.currentKey = key
+        self.currentPage = ret
+        return ret
 
-        if end > last: end = last
-        seq = self.fastafile.fetch(goodchrom, start - 1, end)
-        return core.Sequence(seq.upper())
+    # Getting summary of reference genome access (each page served from the cache saves a fetch)
+    def summary(self):
+        return str(self.requests) + ' requests served by ' + str(self.fetches) + ' fetches (' + str(
+            self.hits) + ' fetches saved)'
+
+
+# Class representing a least recently used cache limited by number of entries and (optionally) total size in bytes
+class LRUCache(object):
+    # Constructor
+    def __init__(self, maxentries, maxbytes):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Getting the value of a key (None if not cached) and marking it as most recently used
+    def get(self, key):
+        if not key in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, size = self.entries.pop(key)
+        self.entries[key] = (value, size)
+        return value
+
+    # Adding a value of the given size, evicting least recently used entries if limits are exceeded
+    def put(self, key, value, size):
+        if key in self.entries: self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while len(self.entries) > 1 and (len(self.entries) > self.maxentries or (self.maxbytes > 0 and self.bytes > self.maxbytes)):
+            _, (_, oldsize) = self.entries.popitem(last=False)
+            self.bytes -= oldsize
+            self.evictions += 1
+
+    # Getting summary of cache usage
+    def summary(self):
+        return str(self.hits) + ' hits, ' + str(self.misses) + ' misses, ' + str(self.evictions) + ' evictions (' + str(
+            len(self.entries)) + ' entries, ' + str(round(self.bytes / 1000.0, 1)) + ' Kbyte)'
+
+
+# Loading the precompiled transcript store of an Ensembl database file (building and saving it if missing or outdated)
+def loadTranscriptStore(filename):
+    if filename in transcriptStores: return transcriptStores[filename]
+
+    stat = os.stat(filename)
+    storefn = filename + '.store'
+    store = None
+    if os.path.isfile(storefn):
+        try:
+            store = TranscriptStore(cPickle.load(open(storefn, 'rb')))
+            if not store.source == (stat.st_size, int(stat.st_mtime)): store = None
+        except Exception:
+            store = None
+
+    # The cache is written to a temporary file and renamed, so that concurrent CAVA runs never read a partial cache
+    if store is None:
+        store = TranscriptStore(buildTranscriptStoreData(filename))
+        tmpfn = storefn + '.' + str(os.getpid()) + '.part'
+        try:
+            with open(tmpfn, 'wb') as out: cPickle.dump(store.data, out, 2)
+            os.rename(tmpfn, storefn)
+        except (IOError, OSError):
+            if os.path.isfile(tmpfn): os.remove(tmpfn)
+
+    transcriptStores[filename] = store
+    return store
+
+
+# Building the serializable data of a transcript store from an Ensembl database file
+def buildTranscriptStoreData(filename):
+    stat = os.stat(filename)
+    bychrom = dict()
+    for line in gzip.open(filename):
+        line = line.rstrip('\n')
+        if line == '' or line.startswith('#'): continue
+        cols = line.split('\t')
+        info = (cols[0], cols[1], cols[2], cols[3], int(cols[5]), int(cols[6]), int(cols[7]), int(cols[8]), int(cols[9]), int(cols[10]))
+        exons = [int(x) for x in cols[11:]]
+        if not cols[4] in bychrom: bychrom[cols[4]] = []
+        bychrom[cols[4]].append((info, exons))
+
+    chroms = dict()
+    for chrom, rows in bychrom.iteritems():
+        # Sorting transcripts by start position (stable, i.e. keeping the order of the database file for ties)
+        rows.sort(key=lambda x: x[0][5])
+        starts = array('l')
+        ends = array('l')
+        maxends = array('l')
+        exonidx = array('l', [0])
+        exoncoords = array('l')
+        for info, exons in rows:
+            starts.append(info[5])
+            ends.append(info[6])
+            if len(maxends) == 0: maxends.append(info[6])
+            else: maxends.append(max(maxends[-1], info[6]))
+            exoncoords.extend(exons)
+            exonidx.append(len(exoncoords))
+        chroms[chrom] = {'starts': starts.tostring(), 'ends': ends.tostring(), 'maxends': maxends.tostring(),
+                         'exonidx': exonidx.tostring(), 'exoncoords': exoncoords.tostring(),
+                         'info': [info for info, _ in rows]}
+
+    return {'source': (stat.st_size, int(stat.st_mtime)), 'chroms': chroms}
+
+
+# Class representing a precompiled transcript store: array-backed transcript and exon coordinates with an interval index per chromosome
+class TranscriptStore(object):
+    # Constructor
+    def __init__(self, data):
+        self.data = data
+        self.source = data['source']
+        self.contigs = set(data['chroms'].keys())
+        self.chroms = dict()
+        for chrom, values in data['chroms'].iteritems():
+            arrays = dict()
+            for key in ['starts', 'ends', 'maxends', 'exonidx', 'exoncoords']:
+                arrays[key] = array('l')
+                arrays[key].fromstring(values[key])
+            arrays['info'] = values['info']
+            self.chroms[chrom] = arrays
+        # Transcript objects created so far
+        self.transcripts = LRUCache(20000, 0)
+
+    # Finding transcripts overlapping with a given position (i.e. transcriptStart < pos <= transcriptEnd), in start order
+    def findTranscripts(self, chrom, pos):
+        if not chrom in self.chroms: return []
+        arrays = self.chroms[chrom]
+        starts = arrays['starts']
+        ends = arrays['ends']
+        maxends = arrays['maxends']
+
+        # Transcripts starting before the position, scanned backwards while any of them may still reach the position
+        ret = []
+        i = bisect.bisect_left(starts, pos) - 1
+        while i >= 0 and maxends[i] >= pos:
+            if ends[i] >= pos: ret.append(self.getTranscript(chrom, i))
+            i -= 1
+        ret.reverse()
+        return ret
+
+    # Getting the transcript object of the i-th transcript of a chromosome
+    def getTranscript(self, chrom, i):
+        key = (chrom, i)
+        ret = self.transcripts.get(key)
+        if ret is None:
+            arrays = self.chroms[chrom]
+            coords = arrays['exoncoords'][arrays['exonidx'][i]:arrays['exonidx'][i + 1]]
+            ret = core.makeTranscript(chrom, arrays['info'][i], coords[0::2], coords[1::2])
+            self.transcripts.put(key, ret, 1)
+        return ret
+
+
+# Transcript stores loaded in this process (shared by the annotation processes forked from it)
+transcriptStores = dict()
+
+
+# Loading the prebuilt coding sequence database created by cds_prep (once in this process)
+def loadCDSDatabase(filename):
+    if not filename in cdsDatabases: cdsDatabases[filename] = CDSDatabase(filename)
+    return cdsDatabases[filename]
+
+
+# Class representing the prebuilt database of reference protein and exon sequences of transcripts (created by cds_prep)
+class CDSDatabase(object):
+    # Constructor
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = dict()
+        for line in open(filename + '.idx'):
+            if line.startswith('#'): continue
+            cols = line.rstrip('\n').split('\t')
+            self.index[cols[0]] = (int(cols[1]), int(cols[2]))
+        # The data file is opened separately in each process, as forked processes would share the file position
+        self.datafile = None
+        self.pid = None
+
+    # Getting the reference protein sequence and the list of exon sequences of a transcript (None if not in the database)
+    def getSequences(self, TRANSCRIPT):
+        if not TRANSCRIPT in self.index: return None
+        if not self.pid == os.getpid():
+            self.datafile = open(self.filename, 'rb')
+            self.pid = os.getpid()
+        offset, length = self.index[TRANSCRIPT]
+        self.datafile.seek(offset)
+        cols = self.datafile.read(length).rstrip('\n').split('\t')
+        exonseqs = []
+        pos = 0
+        for x in cols[2].split(','):
+            exonseqs.append(cols[3][pos:pos + int(x)])
+            pos += int(x)
+        return cols[1], exonseqs
+
+
+# Coding sequence databases loaded in this process (shared by the annotation processes forked from it)
+cdsDatabases = dict()
 
 #######################################################################################################################
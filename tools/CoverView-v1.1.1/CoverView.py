@@ -8,32 +8,39 @@ import datetime
 import numpy
 import multiprocessing
 import json
+import cStringIO
+import Queue
+import itertools
 import transcript
+import profiles
 import warnings
 
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../../pysamdir')
 import pysam
 
+# Number of batches of targets per process, and number of reads used to estimate the read length
+BATCHES_PER_PROCESS = 16
+BATCH_READ_LENGTH_SAMPLE = 1000
+
+# Maximum distance between targets read in one pass through the BAM file, and maximum length of such a cluster
+CLUSTER_MAX_GAP = 200
+CLUSTER_MAX_SPAN = 50000
+
 #########################################################################################################################################
 
 class SingleJob(multiprocessing.Process):
     # Process constructor
-    def __init__(self, threadidx, options, config, startline, endline, names):
+    def __init__(self, threadidx, options, config, bam, targets):
         multiprocessing.Process.__init__(self)
 
         # Initializing variables
         self.threadidx = threadidx
         self.options = options
         self.config = config
-        self.startline = startline
-        self.endline = endline
-        self.names = names
-
-        # Initializing reads directory
-        self.reads = dict()
+        self.targets = targets
 
         # Connecting to BAM file
-        self.samfile = pysam.Samfile(options.input, "rb")
+        self.openBam(bam)
 
         # Connecting to transcript database file
         if not config['transcript_db'] is None:
@@ -41,21 +48,16 @@ class SingleJob(multiprocessing.Process):
         else:
             self.enstdb = None
 
-        # Initializing output files
-        if int(options.threads) > 1:
-            if config['outputs']['regions']:
-                self.out_targets = open(options.output + '_regions_tmp_' + str(threadidx) + '.txt', 'w')
-            if config['outputs']['profiles']:
-                self.out_profiles = open(options.output + '_profiles_tmp_' + str(threadidx) + '.txt', 'w')
-                if not config['transcript_db'] is None:
-                    self.out_poor = open(options.output + '_poor_tmp_' + str(threadidx) + '.txt', 'w')
-        else:
-            if config['outputs']['regions']:
-                self.out_targets = open(options.output + '_regions.txt', 'w')
-            if config['outputs']['profiles']:
-                self.out_profiles = open(options.output + '_profiles.txt', 'w')
-                if not config['transcript_db'] is None:
-                    self.out_poor = open(options.output + '_poor.txt', 'w')
+    # Connecting to a BAM file, and initializing its on-target read counts (and the filter of reads already counted in
+    # approximate mode) and the decoded reads of the latest cluster of targets
+    def openBam(self, bam):
+        self.samfile = pysam.Samfile(bam, "rb")
+        self.reads = dict()
+        self.counted = None
+        if self.config['ontarget_counting'] == 'bloom':
+            self.counted = BloomFilter(int(self.config['ontarget_bloom_mb'] * 8 * 1024 * 1024))
+        self.cluster = None
+        self.clusterreads = None
 
     # Checking if target is fail or pass
     def targetPASS(self, target):
@@ -66,12 +68,14 @@ class SingleJob(multiprocessing.Process):
             if minmax == 'MAX' and summary[metrics] > float(value): return False
         return True
 
-    # Calculating COV, QCOV, MEDBQ, FLBQ, MEDMQ and FLMQ profiles for a region
-    def getProfiles(self, region):
+    # Calculating COV, QCOV, MEDBQ, FLBQ, MEDMQ, FLMQ (and BQ/MQ percentile) profiles for a region
+    def getProfiles(self, region, reads=None):
 
         # Base quality and mapping quality cutoff parameters
         bq_cutoff = float(self.config['low_bq'])
         mq_cutoff = float(self.config['low_mq'])
+        bq_percentiles = self.config['bq_percentiles']
+        mq_percentiles = self.config['mq_percentiles']
 
         # Splitting region to chrom:begin-end
         chrom = region[:region.find(':')]
@@ -85,13 +89,21 @@ class SingleJob(multiprocessing.Process):
         ret_FLBQ = [float('NaN')] * (end - begin)
         ret_MEDMQ = [float('NaN')] * (end - begin)
         ret_FLMQ = [float('NaN')] * (end - begin)
+        ret_PBQ = [[float('NaN')] * (end - begin) for _ in bq_percentiles]
+        ret_PMQ = [[float('NaN')] * (end - begin) for _ in mq_percentiles]
 
-        goodchrom = chrom
-        chrprefix = self.samfile.references[0].startswith('chr')
-        if chrprefix and not chrom.startswith('chr'): goodchrom = 'chr' + chrom
-        if not chrprefix and chrom.startswith('chr'): goodchrom = chrom[3:]
+        goodchrom = self.bamChrom(chrom)
+        if goodchrom is None: return None
 
-        if not goodchrom in self.samfile.references: return None
+        # Calculating profiles from the CIGAR blocks of the reads (falls back to the pileup if the region needs it)
+        if self.config['profile_engine'] == 'numpy':
+            if reads is None:
+                ret = profiles.calculateProfiles(self.samfile, goodchrom, begin, end, bq_cutoff, mq_cutoff,
+                                                 self.config['duplicates'], bq_percentiles, mq_percentiles)
+            else:
+                ret = profiles.profilesFromReads(reads, begin, end, bq_cutoff, mq_cutoff, self.config['duplicates'],
+                                                 bq_percentiles, mq_percentiles)
+            if not ret is None: return ret
 
         # Getting pileup for the given region
         if config['duplicates']:
@@ -140,170 +152,184 @@ class SingleJob(multiprocessing.Process):
                     ret_FLBQ[i] = round(len([x for x in bqs if x < bq_cutoff]) / len(bqs), 3)
                 if len(mqs) > 0:
                     ret_FLMQ[i] = round(len([x for x in mqs if x < mq_cutoff]) / len(mqs), 3)
+                if len(bqs) > 0:
+                    for j in range(len(bq_percentiles)): ret_PBQ[j][i] = numpy.percentile(bqs, bq_percentiles[j])
+                    for j in range(len(mq_percentiles)): ret_PMQ[j][i] = numpy.percentile(mqs, mq_percentiles[j])
                 i += 1
 
-        return ret_COV, ret_QCOV, ret_MEDBQ, ret_FLBQ, ret_MEDMQ, ret_FLMQ
+        ret = {'COV': ret_COV, 'QCOV': ret_QCOV, 'MEDBQ': ret_MEDBQ, 'FLBQ': ret_FLBQ, 'MEDMQ': ret_MEDMQ, 'FLMQ': ret_FLMQ}
+        for j in range(len(bq_percentiles)): ret['P' + str(bq_percentiles[j]) + 'BQ'] = ret_PBQ[j]
+        for j in range(len(mq_percentiles)): ret['P' + str(mq_percentiles[j]) + 'MQ'] = ret_PMQ[j]
+        return ret
 
     # Calculating read counts for a region
-    def readcountsForRegion(self, region):
+    # On-target reads are counted without storing them: a read overlapping several targets is counted only in the first
+    # target (ordered by start position) it overlaps, i.e. in the current target if no preceding target ends after the
+    # start of the read. Alignments with the same read name and position are counted once.
+    def readcountsForRegion(self, region, precedingend, reads=None):
 
         # Splitting region to chrom:begin-end
         chrom = region[:region.find(':')]
         begin = int(region[region.find(':') + 1:region.find('-')])
         end = int(region[region.find('-') + 1:])
 
-        if not chrom in self.reads.keys(): self.reads[chrom] = set()
+        if not chrom in self.reads.keys(): self.reads[chrom] = 0
 
+        goodchrom = self.bamChrom(chrom)
+        if goodchrom is None: return None
+
+        # Position, name and duplicate status of the reads, from the BAM file or from the reads already decoded
+        if reads is None:
+            alignments = ((x.pos, x.qname, x.is_duplicate) for x in self.samfile.fetch(goodchrom, begin, end))
+        else:
+            alignments = reads.alignments(begin, end)
+
+        # In approximate mode, reads are counted if not in the bloom filter of the process. The filter is not shared by
+        # processes, so reads overlapping targets of batches processed by different processes are counted more than once
+        bloom = self.config['ontarget_counting'] == 'bloom'
+        count = 0
+        lastpos = None
+        for (pos, qname, is_duplicate) in alignments:
+            if self.config['duplicates']:
+                count += 1
+            else:
+                if not is_duplicate: count += 1
+
+            if bloom:
+                if self.counted.add(chrom + ':' + qname + ':' + str(pos)): self.reads[chrom] += 1
+            elif pos >= precedingend:
+                if not pos == lastpos:
+                    lastpos = pos
+                    qnames = set()
+                if not qname in qnames:
+                    qnames.add(qname)
+                    self.reads[chrom] += 1
+
+        return count
+
+    # Chromosome name used in the BAM file (None if the chromosome is not in the BAM file)
+    def bamChrom(self, chrom):
         goodchrom = chrom
         chrprefix = self.samfile.references[0].startswith('chr')
         if chrprefix and not chrom.startswith('chr'): goodchrom = 'chr' + chrom
         if not chrprefix and chrom.startswith('chr'): goodchrom = chrom[3:]
 
         if not goodchrom in self.samfile.references: return None
+        return goodchrom
+
+    # Getting the decoded reads of the cluster of a target
+    # The reads of a cluster are read from the BAM file once and kept until a target of another cluster is processed.
+    # Returns None if the reads cannot be used in place of reading the target region (e.g. unusual CIGAR strings).
+    def getClusterReads(self, cluster):
+        if not cluster == self.cluster:
+            (chrom, begin, end) = cluster
+            goodchrom = self.bamChrom(chrom)
+            self.cluster = cluster
+            self.clusterreads = None
+            if not goodchrom is None:
+                self.clusterreads = profiles.decodeReads(self.samfile, goodchrom, begin, end)
+
+        if self.clusterreads is None or not self.clusterreads.exact: return None
+        return self.clusterreads
+
+    # Analysing a single target of the BED file and writing its outputs
+    def processTarget(self, bedtarget):
+        target = dict()
+
+        chrom = bedtarget.chrom
+        begin = bedtarget.begin
+        end = bedtarget.end
+        region = chrom + ':' + str(begin) + '-' + str(end)
+
+        target['Name'] = bedtarget.name
+        target['Chrom'] = chrom
+        target['Start'] = begin + 1
+        target['End'] = end + 1
+
+        # Reads of the cluster of the target, decoded once for the profiles and read counts of all its targets
+        reads = None
+        if self.config['traversal'] == 'clustered': reads = self.getClusterReads(bedtarget.cluster)
+
+        if self.config['outputs']['profiles'] or self.config['outputs']['regions']:
+            profiles = self.getProfiles(region, reads)
+            COV = profiles['COV']
+            QCOV = profiles['QCOV']
+            FLBQ = profiles['FLBQ']
+            FLMQ = profiles['FLMQ']
+            target['Profiles'] = profiles
+
+        summary = dict()
+        summary['RC'] = self.readcountsForRegion(region, bedtarget.precedingEnd, reads)
+
+        if self.config['outputs']['regions']:
+            summary['MEDCOV'] = numpy.median(COV)
+            if len(COV) > 0:
+                summary['MINCOV'] = min(COV)
+            else:
+                summary['MINCOV'] = float('NaN')
+            summary['MEDQCOV'] = numpy.median(QCOV)
+            if len(QCOV) > 0:
+                summary['MINQCOV'] = min(QCOV)
+            else:
+                summary['MINQCOV'] = float('NaN')
+            if len(FLBQ) > 0:
+                summary['MAXFLBQ'] = max(FLBQ)
+            else:
+                summary['MAXFLBQ'] = float('NaN')
+            if len(FLBQ) > 0:
+                summary['MAXFLMQ'] = max(FLMQ)
+            else:
+                summary['MAXFLMQ'] = float('NaN')
+            target['Summary'] = summary
 
-        count = 0
-        for x in self.samfile.fetch(goodchrom, begin, end):
-            if self.config['duplicates']:
-                count += 1
+            if not self.config['fail'] is None:
+                target['PASS'] = self.targetPASS(target)
             else:
-                if not x.is_duplicate: count += 1
-            self.reads[chrom].add((x.qname, x.pos))
+                target['PASS'] = True
 
-        return count
+        else:
+            target['PASS'] = True
+
+        self.output(target)
+
+        return target
 
     # Running process
     def run(self):
 
-        if int(options.threads) == 1:
-
-            if self.config['outputs']['regions']:
-                targetheader = ['Region', 'Chromosome', 'Start_position', 'End_position']
-                if config['transcript']['regions'] and not config['transcript_db'] is None: targetheader.extend(
-                    ['Start_transcript', 'End_transcript'])
-                if not config['fail'] is None: targetheader.append('Pass_or_fail')
-                targetheader.extend(['RC', 'MEDCOV', 'MINCOV', 'MEDQCOV', 'MINQCOV', 'MAXFLMQ', 'MAXFLBQ'])
-                self.out_targets.write('#' + '\t'.join(targetheader) + '\n')
-
-            if self.config['outputs']['profiles']:
-                profheader = ['Chromosome', 'Position']
-                if config['transcript']['profiles'] and not config['transcript_db'] is None: profheader.append(
-                    'Transcript_coordinate')
-                profheader.extend(['COV', 'QCOV', 'MEDBQ', 'FLBQ', 'MEDMQ', 'FLMQ'])
-                self.out_profiles.write('#' + '\t'.join(profheader) + '\n')
-
-            if not config['transcript_db'] is None and config['outputs']['profiles']:
-                poorheader = ['Region', 'Chromosome', 'Start_position', 'End_position', 'Start_transcript',
-                              'End_transcript']
-                self.out_poor.write('#' + '\t'.join(poorheader) + '\n')
-
-        if self.threadidx == 1:
-            print ''
-            sys.stdout.write('Running analysis ... 0.0%')
-            sys.stdout.flush()
+        # Initializing output files
+        (self.out_targets, self.out_profiles, self.out_poor) = openOutputFiles(self.options.output, self.config)
+
+        print ''
+        sys.stdout.write('Running analysis ... 0.0%')
+        sys.stdout.flush()
 
         numOfFails = 0
         counter = 0
-        for line in open(self.options.bedfile):
+        for bedtarget in self.targets:
             counter += 1
 
-            if counter < int(self.startline): continue
-            if not self.endline == '':
-                if counter > int(self.endline): break
-
-            target = dict()
-
-            line = line.rstrip()
-            if line == '': continue
-            if line.startswith('#'): continue
-
-            row = line.split('\t')
-            if len(row) < 4:
-                print "Error: incorrect BED file!"
-                quit()
-
-            key = self.names[counter - 1]
-
-            chrom = row[0]
-            begin = int(row[1])
-            end = int(row[2])
-            if not chrom.startswith('chr'): chrom = 'chr' + chrom
-            region = chrom + ':' + row[1] + '-' + row[2]
-
-            target['Name'] = key
-            target['Chrom'] = chrom
-            target['Start'] = begin + 1
-            target['End'] = end + 1
-
-            if self.config['outputs']['profiles'] or self.config['outputs']['regions']:
-                profiles = dict()
-                COV, QCOV, MEDBQ, FLBQ, MEDMQ, FLMQ = self.getProfiles(region)
-                profiles['COV'] = COV
-                profiles['QCOV'] = QCOV
-                profiles['MEDBQ'] = MEDBQ
-                profiles['FLBQ'] = FLBQ
-                profiles['MEDMQ'] = MEDMQ
-                profiles['FLMQ'] = FLMQ
-                target['Profiles'] = profiles
-
-            summary = dict()
-            summary['RC'] = self.readcountsForRegion(region)
-
-            if self.config['outputs']['regions']:
-                summary['MEDCOV'] = numpy.median(COV)
-                if len(COV) > 0:
-                    summary['MINCOV'] = min(COV)
-                else:
-                    summary['MINCOV'] = float('NaN')
-                summary['MEDQCOV'] = numpy.median(QCOV)
-                if len(QCOV) > 0:
-                    summary['MINQCOV'] = min(QCOV)
-                else:
-                    summary['MINQCOV'] = float('NaN')
-                if len(FLBQ) > 0:
-                    summary['MAXFLBQ'] = max(FLBQ)
-                else:
-                    summary['MAXFLBQ'] = float('NaN')
-                if len(FLBQ) > 0:
-                    summary['MAXFLMQ'] = max(FLMQ)
-                else:
-                    summary['MAXFLMQ'] = float('NaN')
-                target['Summary'] = summary
-
-                if not config['fail'] is None:
-                    target['PASS'] = self.targetPASS(target)
-                else:
-                    target['PASS'] = True
-
-            else:
-                target['PASS'] = True
-
-            self.output(target)
+            target = self.processTarget(bedtarget)
 
             if not target['PASS']: numOfFails += 1
 
-            if self.threadidx == 1:
-                if counter % 100 == 0:
-                    x = round(100 * counter / (numOfTargets / int(self.options.threads)), 1)
-                    x = min(x, 100.0)
-                    sys.stdout.write('\rRunning analysis ... ' + str(x) + '%')
-                    sys.stdout.flush()
+            if counter % 100 == 0:
+                x = round(100 * counter / numOfTargets, 1)
+                x = min(x, 100.0)
+                sys.stdout.write('\rRunning analysis ... ' + str(x) + '%')
+                sys.stdout.flush()
 
-        if self.config['outputs']['regions']: self.out_targets.close()
-        if self.config['outputs']['profiles']:
-            self.out_profiles.close()
-            if not config['transcript_db'] is None:
-                self.out_poor.close()
+        closeOutputFiles((self.out_targets, self.out_profiles, self.out_poor))
 
-        with open(options.output + '_failedtargets_' + str(self.threadidx) + '.txt', 'w') as failedtargetsfile:
+        with open(self.options.output + '_failedtargets_' + str(self.threadidx) + '.txt', 'w') as failedtargetsfile:
             failedtargetsfile.write(str(numOfFails) + '\n')
 
-        with open(options.output + '_reads_on_target_' + str(self.threadidx) + '.txt', 'w') as ontargetfile:
+        with open(self.options.output + '_reads_on_target_' + str(self.threadidx) + '.txt', 'w') as ontargetfile:
             for k, v in self.reads.iteritems():
-                ontargetfile.write(k + ':' + str(len(v)) + '\n')
+                ontargetfile.write(k + ':' + str(v) + '\n')
 
-        if self.threadidx == 1:
-            sys.stdout.write('\rRunning analysis ... 100.0%')
-            sys.stdout.flush()
+        sys.stdout.write('\rRunning analysis ... 100.0%')
+        sys.stdout.flush()
 
     # Outputting target
     def output(self, target):
@@ -321,21 +347,21 @@ class SingleJob(multiprocessing.Process):
                 else:
                     self.output_profiles(target)
 
+    # Getting the transcript coordinates of a target (transcripts are fetched once per target and shared by all outputs)
+    def getTargetTranscripts(self, target):
+        if not 'Transcripts' in target.keys():
+            target['Transcripts'] = transcript.RegionTranscriptCoordinates(self.enstdb, target['Chrom'], target['Start'],
+                                                                           target['End'])
+        return target['Transcripts']
+
     # Writing _target output file
     def output_target(self, target):
         summary = target['Summary']
 
         if self.config['transcript']['regions'] and not self.config['transcript_db'] is None:
-            transcoords_start = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'], target['Start'])
-            transcoords_end = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'], target['End'])
-            v = []
-            for key, value in transcoords_start.iteritems():
-                v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-            transcoordstr_start = ','.join(v)
-            v = []
-            for key, value in transcoords_end.iteritems():
-                v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-            transcoordstr_end = ','.join(v)
+            transcoords = self.getTargetTranscripts(target)
+            transcoordstr_start = transcoords.coordinateString(target['Start'])
+            transcoordstr_end = transcoords.coordinateString(target['End'])
 
         record = [target['Name'], target['Chrom'], str(target['Start']), str(target['End'])]
 
@@ -362,37 +388,36 @@ class SingleJob(multiprocessing.Process):
     # Writing _profiles output file
     def output_profiles(self, target):
         profiles = target['Profiles']
+        writetext = self.config['profiles_format'] == 'txt'
+        transcoordstrs = None
 
-        self.out_profiles.write('\n')
-        self.out_profiles.write('[' + target['Name'] + ']\n')
+        if writetext:
+            self.out_profiles.write('\n')
+            self.out_profiles.write('[' + target['Name'] + ']\n')
 
         if not self.config['transcript_db'] is None:
             window_qcov = {"targetname": None, "chrom": None, "start": None, "transcriptstart": None}
+            if self.config['transcript']['profiles'] or self.config['transcript']['poor']:
+                transcoords = self.getTargetTranscripts(target)
+                if self.config['transcript']['profiles']:
+                    transcoords.calculate()
+                    transcoordstrs = []
+
+        # Positions are only iterated over if text lines, transcript coordinates or poor windows are output
+        if writetext or not transcoordstrs is None or (
+                self.config['transcript']['poor'] and not self.config['transcript_db'] is None):
+            numOfPositions = len(profiles['COV'])
+        else:
+            numOfPositions = 0
 
-        for i in range(len(profiles['COV'])):
+        for i in range(numOfPositions):
             transcoordstr = ''
 
             if self.config['transcript']['profiles'] and not self.config['transcript_db'] is None:
-                transcoords = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'], target['Start'] + i)
-                v = []
-                for key, value in transcoords.iteritems():
-                    v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-                transcoordstr = ','.join(v)
-
-            record = [target['Chrom'], str(target['Start'] + i)]
-            if self.config['transcript']['profiles'] and not self.config['transcript_db'] is None:
-                record.append(transcoordstr)
+                transcoordstr = transcoords.coordinateString(target['Start'] + i)
+                if not writetext: transcoordstrs.append(transcoordstr)
 
-            record.extend(
-                [str(profiles['COV'][i]), str(profiles['QCOV'][i]), str(profiles['MEDBQ'][i]), str(profiles['FLBQ'][i]),
-                 str(profiles['MEDMQ'][i]), str(profiles['FLMQ'][i])])
-
-            if record[-1] == 'nan': record[-1] = '.'
-            if record[-2] == 'nan': record[-2] = '.'
-            if record[-3] == 'nan': record[-3] = '.'
-            if record[-4] == 'nan': record[-4] = '.'
-
-            self.out_profiles.write('\t'.join(record) + '\n')
+            if writetext: self.output_profileLine(target, i, transcoordstr)
 
             if self.config['transcript']['poor'] and not self.config['transcript_db'] is None:
                 if profiles['QCOV'][i] < 15:
@@ -401,22 +426,12 @@ class SingleJob(multiprocessing.Process):
                         window_qcov['chrom'] = target['Chrom']
                         window_qcov['start'] = target['Start'] + i
                         if transcoordstr == '':
-                            transcoords = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'],
-                                                                              target['Start'] + i)
-                            v = []
-                            for key, value in transcoords.iteritems():
-                                v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-                            transcoordstr = ','.join(v)
+                            transcoordstr = transcoords.coordinateString(target['Start'] + i)
                         window_qcov['transcriptstart'] = transcoordstr
                 else:
                     if not window_qcov['transcriptstart'] is None:
 
-                        transcoords = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'],
-                                                                          target['Start'] + i - 1)
-                        v = []
-                        for key, value in transcoords.iteritems():
-                            v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-                        transcoordstr_end = ','.join(v)
+                        transcoordstr_end = transcoords.coordinateString(target['Start'] + i - 1)
 
                         record = [window_qcov['targetname'], window_qcov['chrom'], str(window_qcov['start']),
                                   str(target['Start'] + i - 1), window_qcov['transcriptstart'], transcoordstr_end]
@@ -432,11 +447,7 @@ class SingleJob(multiprocessing.Process):
             if not window_qcov['transcriptstart'] is None:
 
                 if transcoordstr == '':
-                    transcoords = transcript.getTranscriptCoordinates(self.enstdb, target['Chrom'], target['Start'] + i)
-                    v = []
-                    for key, value in transcoords.iteritems():
-                        v.append(key.geneSymbol + ':' + key.ENST + ':' + value)
-                    transcoordstr = ','.join(v)
+                    transcoordstr = transcoords.coordinateString(target['Start'] + i)
 
                 record = [window_qcov['targetname'], window_qcov['chrom'], str(window_qcov['start']),
                           str(target['Start'] + i), window_qcov['transcriptstart'], transcoordstr]
@@ -448,6 +459,169 @@ class SingleJob(multiprocessing.Process):
 
                 window_qcov = {"targetname": None, "chrom": None, "start": None, "transcriptstart": None}
 
+        if not writetext: self.output_profileArray(target, transcoordstrs)
+
+    # Writing the line of a position to the _profiles.txt output file
+    def output_profileLine(self, target, i, transcoordstr):
+        profiles = target['Profiles']
+
+        record = [target['Chrom'], str(target['Start'] + i)]
+        if self.config['transcript']['profiles'] and not self.config['transcript_db'] is None:
+            record.append(transcoordstr)
+
+        record.extend(
+            [str(profiles['COV'][i]), str(profiles['QCOV'][i]), str(profiles['MEDBQ'][i]), str(profiles['FLBQ'][i]),
+             str(profiles['MEDMQ'][i]), str(profiles['FLMQ'][i])])
+
+        if record[-1] == 'nan': record[-1] = '.'
+        if record[-2] == 'nan': record[-2] = '.'
+        if record[-3] == 'nan': record[-3] = '.'
+        if record[-4] == 'nan': record[-4] = '.'
+
+        for key in percentileColumns(self.config):
+            value = str(profiles[key][i])
+            if value == 'nan': value = '.'
+            record.append(value)
+
+        self.out_profiles.write('\t'.join(record) + '\n')
+
+    # Writing the profiles of a target to the _profiles.npz output file
+    def output_profileArray(self, target, transcoordstrs):
+        array = profiles.makeProfileArray(target['Profiles'], target['Start'], percentileColumns(self.config),
+                                          transcoordstrs)
+        self.out_profiles.append((target['Name'], target['Chrom'], target['Start'], target['End'],
+                                  profiles.serializeArray(array)))
+
+
+#########################################################################################################################################
+
+class BatchJob(SingleJob):
+    # Process constructor
+    def __init__(self, threadidx, options, config, bams, targets, taskqueue, resultqueue):
+        SingleJob.__init__(self, threadidx, options, config, bams[0], targets)
+
+        # BAM files, on-target read counts and bloom filters of the samples (the first sample is already connected)
+        self.bams = bams
+        self.sampleidx = 0
+        self.samples = {0: (self.samfile, self.reads, self.counted)}
+
+        # Transcript coordinates of the targets of the latest batch, shared by all samples
+        self.transcriptbatch = None
+        self.transcripts = dict()
+
+        # Queues of (target batch, sample) jobs and of their outputs
+        self.taskqueue = taskqueue
+        self.resultqueue = resultqueue
+
+    # Switching to the BAM file and on-target read counts of a sample
+    def selectSample(self, sampleidx):
+        if sampleidx == self.sampleidx: return
+        if sampleidx in self.samples.keys():
+            (self.samfile, self.reads, self.counted) = self.samples[sampleidx]
+            self.cluster = None
+            self.clusterreads = None
+        else:
+            self.openBam(self.bams[sampleidx])
+            self.samples[sampleidx] = (self.samfile, self.reads, self.counted)
+        self.sampleidx = sampleidx
+
+    # Getting the transcript coordinates of a target (shared by all samples the batch of the target is processed for)
+    def getTargetTranscripts(self, target):
+        if not 'Transcripts' in target.keys() and target['Name'] in self.transcripts.keys():
+            target['Transcripts'] = self.transcripts[target['Name']]
+        ret = SingleJob.getTargetTranscripts(self, target)
+        self.transcripts[target['Name']] = ret
+        return ret
+
+    # Running process
+    def run(self):
+        while True:
+            job = self.taskqueue.get()
+            if job is None: break
+            batchidx, sampleidx, first, last = job
+
+            self.selectSample(sampleidx)
+            if not batchidx == self.transcriptbatch:
+                self.transcriptbatch = batchidx
+                self.transcripts = dict()
+
+            # Writing the outputs of the batch into in-memory buffers
+            self.out_targets = cStringIO.StringIO()
+            if self.config['profiles_format'] == 'npz':
+                self.out_profiles = []
+            else:
+                self.out_profiles = cStringIO.StringIO()
+            self.out_poor = cStringIO.StringIO()
+
+            # Summary metrics of the targets used in the cohort matrices
+            summaries = []
+
+            numOfFails = 0
+            for bedtarget in self.targets[first:last]:
+                target = self.processTarget(bedtarget)
+                if not target['PASS']: numOfFails += 1
+                if self.config['outputs']['regions']:
+                    summaries.append((target['Name'], target['Chrom'], target['Start'], target['End'],
+                                      target['Summary']['MEDCOV'], target['Summary']['MINQCOV']))
+
+            if self.config['profiles_format'] == 'npz':
+                profilesout = self.out_profiles
+            else:
+                profilesout = self.out_profiles.getvalue()
+                self.out_profiles.close()
+
+            self.resultqueue.put((batchidx, sampleidx, self.out_targets.getvalue(), profilesout,
+                                  self.out_poor.getvalue(), numOfFails, last - first, summaries))
+
+            self.out_targets.close()
+            self.out_poor.close()
+
+        self.resultqueue.put((None, dict((k, v[1]) for k, v in self.samples.iteritems())))
+
+
+#########################################################################################################################################
+
+# Class representing a bloom filter of strings, used to count on-target reads approximately in bounded memory
+class BloomFilter(object):
+    # Constructor
+    def __init__(self, numOfBits, numOfHashes=4):
+        self.numOfBits = numOfBits
+        self.numOfHashes = numOfHashes
+        self.bits = bytearray(numOfBits // 8 + 1)
+
+    # Adding key to the filter; returns False if the key was (probably) added before
+    def add(self, key):
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        new = False
+        for i in range(self.numOfHashes):
+            bit = (h1 + i * h2) % self.numOfBits
+            byte = bit >> 3
+            mask = 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                new = True
+        return new
+
+
+#########################################################################################################################################
+
+# Class representing a target of the BED file: chromosome ('chr' prefixed), begin and end (as in the BED file), unique
+# name, the largest end of the targets preceding it on the chromosome and the region of its cluster
+# Attributes are listed in __slots__ to keep the targets of large BED files small.
+class BedTarget(object):
+    __slots__ = ['chrom', 'begin', 'end', 'name', 'precedingEnd', 'cluster']
+
+    # Constructor
+    def __init__(self, chrom, begin, end):
+        self.chrom = chrom
+        self.begin = begin
+        self.end = end
+        self.name = None
+        self.precedingEnd = -1
+        self.cluster = None
+
 
 #########################################################################################################################################
 
@@ -460,7 +634,7 @@ def printInfo(options, config, numOfTargets):
         print "Configuration file:     " + options.config
     else:
         print "Configuration file:     using default settings"
-    print "Input file name:        " + options.input
+    printInputInfo(options)
     print "BED file name:          " + options.bedfile + targetstxt
     print ''
     if not config['transcript_db'] is None and (config['outputs']['regions'] or config['outputs']['profiles']) and (
@@ -471,12 +645,17 @@ def printInfo(options, config, numOfTargets):
     formats = '_summary'
     if config['outputs']['regions']: formats += ', _regions'
     if config['outputs']['profiles']:
+        if config['profiles_format'] == 'npz':
+            profilesfile = ', _profiles.npz'
+        else:
+            profilesfile = ', _profiles'
         if config['only_fail_profiles']:
-            formats += ', _profiles (failed regions)'
+            formats += profilesfile + ' (failed regions)'
         else:
-            formats += ', _profiles (all regions)'
+            formats += profilesfile + ' (all regions)'
     if not config['transcript_db'] is None and config['outputs']['profiles'] and config['transcript']['poor']:
         formats += ', _poor'
+    if not options.bamlist is None and config['outputs']['regions']: formats += ', _cohort_MEDCOV, _cohort_MINQCOV'
     print "Output formats:         " + formats
     print "Output files prefix:    " + options.output
     print ''
@@ -496,14 +675,26 @@ def printInfo(options, config, numOfTargets):
         print ''
     if int(options.threads) > 1:
         print 'Multithreading:         ' + str(options.threads) + ' processes'
+    if config['ontarget_counting'] == 'bloom':
+        print 'On-target reads:        Approximate (bloom filter of ' + str(config['ontarget_bloom_mb']) + ' Mb per process)'
+        if int(options.threads) > 1:
+            print '                        Reads overlapping targets of several processes are counted more than once'
     print "--------------------------------------------------------------------------------------"
 
 
+# Printing out the input BAM file name(s)
+def printInputInfo(options):
+    if options.bamlist is None:
+        print "Input file name:        " + options.input
+    else:
+        print "BAM list file name:     " + options.bamlist + ' (' + str(len(readBamList(options.bamlist))) + ' samples)'
+
+
 # Printing out info (no BED file)
 def printInfo_minimal(options):
     print 'Input, output and settings:'
     print "--------------------------------------------------------------------------------------"
-    print "Input file name:        " + options.input
+    printInputInfo(options)
     print ''
     print "Output formats:         _summary"
     print "Output files prefix:    " + options.output
@@ -525,12 +716,28 @@ def defaultConfigs(config):
     if not 'regions' in config['transcript'].keys(): config['transcript']['regions'] = True
     if not 'profiles' in config['transcript'].keys(): config['transcript']['profiles'] = True
     if not 'poor' in config['transcript'].keys(): config['transcript']['poor'] = True
+    if not 'profile_engine' in config.keys(): config['profile_engine'] = 'numpy'
+    if not 'bq_percentiles' in config.keys(): config['bq_percentiles'] = []
+    if not 'mq_percentiles' in config.keys(): config['mq_percentiles'] = []
+    if not 'ontarget_counting' in config.keys(): config['ontarget_counting'] = 'exact'
+    if not 'ontarget_bloom_mb' in config.keys(): config['ontarget_bloom_mb'] = 128
+    if not 'full_scan' in config.keys(): config['full_scan'] = False
+    if not 'profiles_format' in config.keys(): config['profiles_format'] = 'txt'
+    if not 'traversal' in config.keys(): config['traversal'] = 'clustered'
+
+
+# Creating the list of percentile profile column names (e.g. P10BQ)
+def percentileColumns(config):
+    ret = ['P' + str(p) + 'BQ' for p in config['bq_percentiles']]
+    ret.extend(['P' + str(p) + 'MQ' for p in config['mq_percentiles']])
+    return ret
 
 
-# Creating target name list
-def makeNames(inputf):
+# Reading the targets of the BED file in a single pass
+# Returns the list of targets (BedTarget objects) in BED order, with their names, preceding ends and clusters set.
+def readTargets(inputf):
     ret = []
-    latest = dict()
+    labels = []
     for line in open(inputf):
         line = line.rstrip()
         if line == '': continue
@@ -541,127 +748,310 @@ def makeNames(inputf):
             print "Incorrect BED file format: less than 4 columns!"
             exit(1)
 
-        if cols[3] in latest.keys():
-            latest[cols[3]] += 1
-        else:
-            latest[cols[3]] = 1
+        chrom = cols[0]
+        if not chrom.startswith('chr'): chrom = 'chr' + chrom
+        ret.append(BedTarget(chrom, int(cols[1]), int(cols[2])))
+        labels.append(cols[3])
+
+    names = makeNames(labels)
+    for i in range(len(ret)): ret[i].name = names[i]
+    findPrecedingEnds(ret)
+    findClusters(ret)
+
+    return ret
+
 
-        ret.append(cols[3] + '_' + str(latest[cols[3]]))
+# Creating target name list from the names (4th column) of the BED file
+# Repeated names are numbered (name_1, name_2, ...); a name_1 is renamed back to name if there is no name_2 among the
+# names at that point.
+def makeNames(labels):
+    ret = []
+    latest = dict()
+    for label in labels:
+        latest[label] = latest.get(label, 0) + 1
+        ret.append(label + '_' + str(latest[label]))
+
+    current = dict()
+    for x in ret: current[x] = current.get(x, 0) + 1
 
     for i in range(len(ret)):
         x = ret[i]
         if x.endswith('_1'):
-            if not x[:-2] + '_2' in ret:
+            if not x[:-2] + '_2' in current:
                 ret[i] = x[:-2]
+                current[x] -= 1
+                if current[x] == 0: del current[x]
+                current[x[:-2]] = current.get(x[:-2], 0) + 1
 
     return ret
 
 
-# Finding break points in the input file
-def findFileBreaks(inputf, threads):
+# Finding the largest end position of the targets preceding each target (ordered by start position) on the same
+# chromosome, used to count reads overlapping several targets only once
+def findPrecedingEnds(targets):
+    prevchrom = None
+    maxend = -1
+    for i in sorted(range(len(targets)), key=lambda i: (targets[i].chrom, targets[i].begin, i)):
+        target = targets[i]
+        if not target.chrom == prevchrom:
+            prevchrom = target.chrom
+            maxend = -1
+        target.precedingEnd = maxend
+        maxend = max(maxend, target.end)
+
+
+# Grouping the targets into clusters of overlapping or nearby targets on the same chromosome, whose reads are read from
+# the BAM file in a single pass
+# The cluster of each target is the (chrom, begin, end) region containing the regions read for the profiles and read
+# counts of its targets.
+def findClusters(targets):
+    cluster = None
+    members = []
+    for i in sorted(range(len(targets)), key=lambda i: (targets[i].chrom, targets[i].begin, i)):
+        chrom = targets[i].chrom
+        begin = max(targets[i].begin - 1, 0)
+        end = targets[i].end
+        nearby = not cluster is None and chrom == cluster[0] and begin <= cluster[2] + CLUSTER_MAX_GAP
+        if nearby and max(end, cluster[2]) - cluster[1] <= CLUSTER_MAX_SPAN:
+            cluster = (chrom, cluster[1], max(end, cluster[2]))
+        else:
+            for j in members: targets[j].cluster = cluster
+            cluster = (chrom, begin, end)
+            members = []
+        members.append(i)
+    for j in members: targets[j].cluster = cluster
+
+
+# Estimating the read depth of each chromosome from the numbers of mapped reads in the BAM index and the read length of
+# the first reads of the BAM file
+def estimateDepths(samfile, inputfn):
+    readlengths = [x.rlen for x in itertools.islice(samfile.fetch(), BATCH_READ_LENGTH_SAMPLE)]
+    if len(readlengths) > 0:
+        readlength = sum(readlengths) / len(readlengths)
+    else:
+        readlength = 0
+
+    ret = dict()
+    for line in pysam.idxstats(inputfn):
+        cols = line.rstrip('\n').split('\t')
+        if cols[0] == '*' or int(cols[1]) == 0: continue
+        depth = int(cols[2]) * readlength / int(cols[1])
+        ret[cols[0]] = depth
+        if not cols[0].startswith('chr'): ret['chr' + cols[0]] = depth
+    return ret
+
+
+# Splitting the targets into batches of consecutive targets with similar estimated cost (target length x estimated read
+# depth), so that processes can pull small batches until all targets are done
+# Consecutive targets of the same cluster are kept in the same batch. Batches are returned as (first, last) index ranges.
+def makeBatches(targets, depths, threads):
+    costs = [(t.end - t.begin + 1) * max(depths.get(t.chrom, 0), 1) for t in targets]
+    quota = sum(costs) / (threads * BATCHES_PER_PROCESS)
+
     ret = []
-    started = False
-    counter = 0
-    for line in open(inputf):
-        counter += 1
-        line = line.strip()
-        if line == '' or line.startswith('#'):
-            continue
-        if not started:
-            started = True
-            first = counter
-    delta = int((counter - first + 1) / threads)
+    first = 0
+    batchcost = 0
+    for i in range(len(targets)):
+        batchcost += costs[i]
+        if batchcost >= quota and (i + 1 == len(targets) or not targets[i + 1].cluster == targets[i].cluster):
+            ret.append((first, i + 1))
+            first = i + 1
+            batchcost = 0
+    if first < len(targets): ret.append((first, len(targets)))
 
-    counter = 0
-    prevchrom = ''
-    i = 0
-    start = 0
-    for line in open(inputf):
-        counter += 1
-        line = line.strip()
-        if line == '' or line.startswith('#'):
+    return ret
+
+
+# Queueing the (batch, sample) jobs for the processes, receiving their outputs and writing them to the output files of
+# each sample in BED order
+# Jobs are queued while fewer than two per process are queued or waiting for preceding jobs to be written, so that the
+# outputs of jobs finished out of order are kept only for a bounded number of jobs.
+# In batch mode (cohortprefix given), MEDCOV and MINQCOV of each target and sample are also written to the cohort matrix
+# files, once the batch of the targets has been done for all samples.
+def writeBatchOutput(prefixes, samplenames, cohortprefix, config, jobs, taskqueue, resultqueue, processes, numOfTargets):
+    outfiles = [openOutputFiles(prefix, config) for prefix in prefixes]
+
+    cohortfiles = None
+    if not cohortprefix is None and config['outputs']['regions']:
+        cohortfiles = []
+        for metrics in ['MEDCOV', 'MINQCOV']:
+            cohortfile = open(cohortprefix + '_cohort_' + metrics + '.txt', 'w')
+            header = ['Region', 'Chromosome', 'Start_position', 'End_position'] + samplenames
+            cohortfile.write('#' + '\t'.join(header) + '\n')
+            cohortfiles.append(cohortfile)
+
+    print ''
+    sys.stdout.write('Running analysis ... 0.0%')
+    sys.stdout.flush()
+
+    pending = [dict() for _ in prefixes]
+    nextidx = [0] * len(prefixes)
+    cohortpending = dict()
+    nextcohortidx = 0
+    finished = 0
+    done = 0
+    failedtargets = [0] * len(prefixes)
+    ontarget = [dict() for _ in prefixes]
+    window = 2 * len(processes)
+    queued = 0
+    written = 0
+    stopped = False
+    while finished < len(processes):
+        while queued < len(jobs) and queued - written < window:
+            taskqueue.put(jobs[queued])
+            queued += 1
+        if queued == len(jobs) and not stopped:
+            for process in processes: taskqueue.put(None)
+            stopped = True
+
+        try:
+            result = resultqueue.get(timeout=1)
+        except Queue.Empty:
+            for process in processes:
+                if process.exitcode is not None and not process.exitcode == 0:
+                    for p in processes: p.terminate()
+                    print '\nError: process ' + str(process.threadidx) + ' failed.\n'
+                    quit()
             continue
-        cols = line.split('\t')
-        chrom = cols[0]
 
-        if counter > delta and not chrom == prevchrom:
-            ret.append((start, i))
-            start = i + 1
-            counter = 0
+        # On-target read counts of the samples are sent by each process when the queue of jobs is empty
+        if result[0] is None:
+            for sampleidx, reads in result[1].iteritems():
+                for k, v in reads.iteritems():
+                    if k in ontarget[sampleidx].keys():
+                        ontarget[sampleidx][k] += v
+                    else:
+                        ontarget[sampleidx][k] = v
+            finished += 1
+            continue
 
-        prevchrom = chrom
-        i += 1
-    ret.append((start, ''))
+        # Batches finished out of order are kept until all preceding batches of the sample have been written
+        batchidx, sampleidx = result[:2]
+        pending[sampleidx][batchidx] = result[2:]
+        while nextidx[sampleidx] in pending[sampleidx]:
+            targetstxt, profilesout, poortxt, numOfFails, numOfLines, summaries = pending[sampleidx].pop(
+                nextidx[sampleidx])
+            (out_targets, out_profiles, out_poor) = outfiles[sampleidx]
+            if not out_targets is None: out_targets.write(targetstxt)
+            if not out_profiles is None:
+                if config['profiles_format'] == 'npz':
+                    for record in profilesout: out_profiles.append(record)
+                else:
+                    out_profiles.write(profilesout)
+            if not out_poor is None: out_poor.write(poortxt)
+            failedtargets[sampleidx] += numOfFails
+            done += numOfLines
+            nextidx[sampleidx] += 1
+            written += 1
+
+            if not cohortfiles is None:
+                if not nextidx[sampleidx] - 1 in cohortpending.keys(): cohortpending[nextidx[sampleidx] - 1] = dict()
+                cohortpending[nextidx[sampleidx] - 1][sampleidx] = summaries
+
+            x = min(round(100 * done / (numOfTargets * len(prefixes)), 1), 100.0)
+            sys.stdout.write('\rRunning analysis ... ' + str(x) + '%')
+            sys.stdout.flush()
 
-    return ret
+        # Writing the cohort matrix rows of the batches done for all samples
+        while nextcohortidx in cohortpending and len(cohortpending[nextcohortidx]) == len(prefixes):
+            writeCohortRows(cohortfiles, cohortpending.pop(nextcohortidx), len(prefixes))
+            nextcohortidx += 1
 
+    for x in outfiles: closeOutputFiles(x)
+    if not cohortfiles is None:
+        for cohortfile in cohortfiles: cohortfile.close()
 
-# Merging tmp files to final output files
-def mergeTmpFiles(options, config):
-    if config['outputs']['regions']:
+    sys.stdout.write('\rRunning analysis ... 100.0%')
+    sys.stdout.flush()
 
-        filenames = []
-        for i in range(1, int(options.threads) + 1):
-            filenames.append(options.output + '_regions_tmp_' + str(i) + '.txt')
+    return failedtargets, ontarget
 
-        with open(options.output + '_regions.txt', 'w') as outfile:
-            targetheader = ['Region', 'Chromosome', 'Start_position', 'End_position']
-            if config['transcript']['regions'] and not config['transcript_db'] is None: targetheader.extend(
-                ['Start_transcript', 'End_transcript'])
-            if not config['fail'] is None: targetheader.append('Pass_or_fail')
-            targetheader.extend(['RC', 'MEDCOV', 'MINCOV', 'MEDQCOV', 'MINQCOV', 'MAXFLMQ', 'MAXFLBQ'])
-            outfile.write('#' + '\t'.join(targetheader) + '\n')
 
-            for fname in filenames:
-                with open(fname) as infile:
-                    for line in infile:
-                        outfile.write(line)
+# Writing the rows of the targets of a batch to the cohort matrix files (summaries are given for each sample)
+def writeCohortRows(cohortfiles, summaries, numOfSamples):
+    for i in range(len(summaries[0])):
+        (name, chrom, start, end) = summaries[0][i][:4]
+        for j in range(len(cohortfiles)):
+            record = [name, chrom, str(start), str(end)]
+            for sampleidx in range(numOfSamples):
+                value = str(summaries[sampleidx][i][4 + j])
+                if value == 'nan': value = '.'
+                record.append(value)
+            cohortfiles[j].write('\t'.join(record) + '\n')
 
-        for fn in filenames:
-            os.remove(fn)
 
+# Opening the _regions, _profiles and _poor output files (None if not written) and writing their headers
+def openOutputFiles(prefix, config):
+    out_targets = None
+    out_profiles = None
+    out_poor = None
+    if config['outputs']['regions']:
+        out_targets = open(prefix + '_regions.txt', 'w')
+        out_targets.write(regionsHeader(config))
     if config['outputs']['profiles']:
+        if config['profiles_format'] == 'npz':
+            out_profiles = profiles.ProfileWriter(prefix + '_profiles.npz')
+        else:
+            out_profiles = open(prefix + '_profiles.txt', 'w')
+            out_profiles.write(profilesHeader(config))
+        if not config['transcript_db'] is None:
+            out_poor = open(prefix + '_poor.txt', 'w')
+            out_poor.write(poorHeader())
+    return (out_targets, out_profiles, out_poor)
+
+
+# Closing the output files opened by openOutputFiles
+def closeOutputFiles(outfiles):
+    for outfile in outfiles:
+        if not outfile is None: outfile.close()
+
 
-        filenames = []
-        for i in range(1, int(options.threads) + 1):
-            filenames.append(options.output + '_profiles_tmp_' + str(i) + '.txt')
+# Reading the list of BAM files of batch mode (one file name per line)
+def readBamList(inputf):
+    ret = []
+    for line in open(inputf):
+        line = line.strip()
+        if line == '' or line.startswith('#'): continue
+        ret.append(line)
+    return ret
 
-        with open(options.output + '_profiles.txt', 'w') as outfile:
-            profheader = ['Chromosome', 'Position']
-            if config['transcript']['profiles'] and not config['transcript_db'] is None: profheader.append(
-                'Transcript_coordinate')
-            profheader.extend(['COV', 'QCOV', 'MEDBQ', 'FLBQ', 'MEDMQ', 'FLMQ'])
-            outfile.write('#' + '\t'.join(profheader) + '\n')
 
-            for fname in filenames:
-                with open(fname) as infile:
-                    for line in infile:
-                        outfile.write(line)
+# Sample name of a BAM file (file name without directory and .bam extension)
+def sampleName(bam):
+    ret = os.path.basename(bam)
+    if ret.endswith('.bam'): ret = ret[:-4]
+    return ret
 
-        for fn in filenames: os.remove(fn)
 
-    if config['transcript']['poor'] and not config['transcript_db'] is None and config['outputs']['profiles']:
+# Header line of the _regions output file
+def regionsHeader(config):
+    targetheader = ['Region', 'Chromosome', 'Start_position', 'End_position']
+    if config['transcript']['regions'] and not config['transcript_db'] is None: targetheader.extend(
+        ['Start_transcript', 'End_transcript'])
+    if not config['fail'] is None: targetheader.append('Pass_or_fail')
+    targetheader.extend(['RC', 'MEDCOV', 'MINCOV', 'MEDQCOV', 'MINQCOV', 'MAXFLMQ', 'MAXFLBQ'])
+    return '#' + '\t'.join(targetheader) + '\n'
 
-        filenames = []
-        for i in range(1, int(options.threads) + 1):
-            filenames.append(options.output + '_poor_tmp_' + str(i) + '.txt')
 
-        with open(options.output + '_poor.txt', 'w') as outfile:
-            poorheader = ['Region', 'Chromosome', 'Start_position', 'End_position', 'Start_transcript',
-                          'End_transcript']
-            outfile.write('#' + '\t'.join(poorheader) + '\n')
+# Header line of the _profiles output file
+def profilesHeader(config):
+    profheader = ['Chromosome', 'Position']
+    if config['transcript']['profiles'] and not config['transcript_db'] is None: profheader.append(
+        'Transcript_coordinate')
+    profheader.extend(['COV', 'QCOV', 'MEDBQ', 'FLBQ', 'MEDMQ', 'FLMQ'])
+    profheader.extend(percentileColumns(config))
+    return '#' + '\t'.join(profheader) + '\n'
 
-            for fname in filenames:
-                with open(fname) as infile:
-                    for line in infile:
-                        outfile.write(line)
 
-        for fn in filenames: os.remove(fn)
+# Header line of the _poor output file
+def poorHeader():
+    poorheader = ['Region', 'Chromosome', 'Start_position', 'End_position', 'Start_transcript', 'End_transcript']
+    return '#' + '\t'.join(poorheader) + '\n'
 
 
 # Writing _summary output file
-def output_summary(options, chromdata):
-    out_summary = open(options.output + '_summary.txt', 'w')
+def output_summary(output, chromdata):
+    out_summary = open(output + '_summary.txt', 'w')
     out_summary.write('#CHROM\tRC\tRCIN\tRCOUT\n')
     mapped = chromdata['Mapped']
     unmapped = chromdata['Unmapped']
@@ -678,22 +1068,52 @@ def output_summary(options, chromdata):
     out_summary.close()
 
 
+# Counting reads per chromosome and in total, from the BAM index statistics or (if full_scan is set) by a full pass
+# through the BAM file
+def countReads(samfile, config, message):
+    counts = []
+    allreads = 0
+
+    if not config['full_scan']:
+        for line in pysam.idxstats(samfile.filename):
+            cols = line.rstrip('\n').split('\t')
+            n = int(cols[2]) + int(cols[3])
+            if not cols[0] == '*': counts.append((cols[0], n))
+            allreads += n
+        return counts, allreads
+
+    chroms = samfile.references
+    i = 0
+    for chrom in chroms:
+        counts.append((chrom, sum(1 for _ in samfile.fetch(chrom))))
+
+        i += 1
+
+        x = round(100 * i / len(chroms), 1)
+        x = min(x, 100.0)
+        sys.stdout.write('\r' + message + ' ... ' + str(x) + '%')
+        sys.stdout.flush()
+
+    allreads = pysam.flagstat(samfile.filename)[0]
+    allreads = allreads[:allreads.find('+')]
+    allreads = int(allreads.strip())
+
+    return counts, allreads
+
+
 # Calculating chromosome data
-def calculateChromdata(samfile, ontarget):
+def calculateChromdata(samfile, ontarget, config):
     sys.stdout.write('\rFinalizing analysis ... 0.0%')
     sys.stdout.flush()
 
     chromdata = dict()
-    chroms = samfile.references
     chromsres = []
     alltotal = 0
     allon = 0
     alloff = 0
 
-    i = 0
-    for chrom in chroms:
-
-        total = sum(1 for _ in samfile.fetch(chrom))
+    counts, allreads = countReads(samfile, config, 'Finalizing analysis')
+    for (chrom, total) in counts:
 
         if 'chr' + chrom in ontarget.keys():
             on = int(ontarget['chr' + chrom])
@@ -706,20 +1126,9 @@ def calculateChromdata(samfile, ontarget):
         allon += on
         alloff += off
 
-        i += 1
-
-        x = round(100 * i / len(chroms), 1)
-        x = min(x, 100.0)
-        sys.stdout.write('\rFinalizing analysis ... ' + str(x) + '%')
-        sys.stdout.flush()
-
     chromdata['Chroms'] = chromsres
     chromdata['Mapped'] = {'RC': alltotal, 'RCIN': allon, 'RCOUT': alloff}
 
-    allreads = pysam.flagstat(options.input)[0]
-    allreads = allreads[:allreads.find('+')]
-    allreads = int(allreads.strip())
-
     chromdata['Total'] = allreads
     chromdata['Unmapped'] = allreads - alltotal
 
@@ -731,38 +1140,23 @@ def calculateChromdata(samfile, ontarget):
 
 
 # Calculating chromosome data (minimal mode)
-def calculateChromdata_minimal(samfile):
+def calculateChromdata_minimal(samfile, config):
     print ''
     sys.stdout.write('\rRunning analysis ... 0.0%')
     sys.stdout.flush()
 
     chromdata = dict()
-    chroms = samfile.references
     chromsres = []
     alltotal = 0
-    allon = 0
-    alloff = 0
 
-    i = 0
-    for chrom in chroms:
-        total = sum(1 for _ in samfile.fetch(chrom))
+    counts, allreads = countReads(samfile, config, 'Running analysis')
+    for (chrom, total) in counts:
         chromsres.append({'CHROM': chrom, 'RC': total})
         alltotal += total
 
-        i += 1
-
-        x = round(100 * i / len(chroms), 1)
-        x = min(x, 100.0)
-        sys.stdout.write('\rRunning analysis ... ' + str(x) + '%')
-        sys.stdout.flush()
-
     chromdata['Chroms'] = chromsres
     chromdata['Mapped'] = {'RC': alltotal}
 
-    allreads = pysam.flagstat(options.input)[0]
-    allreads = allreads[:allreads.find('+')]
-    allreads = int(allreads.strip())
-
     chromdata['Total'] = allreads
     chromdata['Unmapped'] = allreads - alltotal
 
@@ -774,8 +1168,8 @@ def calculateChromdata_minimal(samfile):
 
 
 # Writing _summary output file (minimal mode)
-def output_summary_minimal(options, chromdata):
-    out_summary = open(options.output + '_summary.txt', 'w')
+def output_summary_minimal(output, chromdata):
+    out_summary = open(output + '_summary.txt', 'w')
     out_summary.write('#CHROM\tRC\n')
     mapped = chromdata['Mapped']
     unmapped = chromdata['Unmapped']
@@ -813,6 +1207,9 @@ parser.add_option("-c", "--config", default=None, dest='config', action='store',
                   help="Configuration file [default value: %default]")
 parser.add_option("-t", "--threads", default=1, dest='threads', action='store',
                   help="Number of processes used [default value: %default]")
+parser.add_option("--bamlist", default=None, dest='bamlist', action='store',
+                  help="File listing input (BAM) filenames, one per line, analysed in batch mode; outputs are written "
+                       "with the <output>_<sample> prefix [default value: %default]")
 (options, args) = parser.parse_args()
 
 # Loading configuration file
@@ -820,79 +1217,128 @@ config = dict()
 if not options.config is None:
     with open(options.config) as config_file: config = json.load(config_file)
 defaultConfigs(config)
+if not config['profile_engine'] in ['numpy', 'pileup']:
+    print "Error: profile_engine must be either \"numpy\" or \"pileup\""
+    quit()
+for p in config['bq_percentiles'] + config['mq_percentiles']:
+    if not 0 <= p <= 100:
+        print "Error: bq_percentiles and mq_percentiles must be between 0 and 100"
+        quit()
+if not config['ontarget_counting'] in ['exact', 'bloom']:
+    print "Error: ontarget_counting must be either \"exact\" or \"bloom\""
+    quit()
+if not config['ontarget_bloom_mb'] > 0:
+    print "Error: ontarget_bloom_mb must be positive"
+    quit()
+if config['ontarget_counting'] == 'bloom' and not options.bamlist is None:
+    print "Error: ontarget_counting \"bloom\" cannot be used with --bamlist (use \"exact\", which needs no memory per read)"
+    quit()
+if not config['profiles_format'] in ['txt', 'npz']:
+    print "Error: profiles_format must be either \"txt\" or \"npz\""
+    quit()
+if not config['traversal'] in ['clustered', 'target']:
+    print "Error: traversal must be either \"clustered\" or \"target\""
+    quit()
 
 # Removing unremoved temporary files if exist
 if os.path.isfile(options.output + '_failedtargets.txt'): os.remove(options.output + '_failedtargets.txt')
 if os.path.isfile(options.output + '_reads_on_target.txt'): os.remove(options.output + '_reads_on_target.txt')
 
+# Input BAM files and output prefixes of the samples (batch mode) or of the single input file
+if options.bamlist is None:
+    bams = [options.input]
+    prefixes = [options.output]
+else:
+    if not os.path.isfile(options.bamlist):
+        print "Error: BAM list file not found"
+        quit()
+    bams = readBamList(options.bamlist)
+    samplenames = [sampleName(bam) for bam in bams]
+    if len(bams) == 0:
+        print "Error: BAM list file is empty"
+        quit()
+    if not len(set(samplenames)) == len(samplenames):
+        print "Error: BAM files with the same sample name in the BAM list file"
+        quit()
+    prefixes = [options.output + '_' + x for x in samplenames]
+
 # Minimal mode (no BED file)
 if options.bedfile is None:
     printInfo_minimal(options)
-    samfile = pysam.Samfile(options.input, "rb")
-    chromdata = calculateChromdata_minimal(samfile)
-    output_summary_minimal(options, chromdata)
+    for i in range(len(bams)):
+        samfile = pysam.Samfile(bams[i], "rb")
+        chromdata = calculateChromdata_minimal(samfile, config)
+        output_summary_minimal(prefixes[i], chromdata)
     print ""
     print 'CoverView v1.1.1 succesfully finished: ', datetime.datetime.now()
     print "======================================================================================"
     print ""
     quit()
 
-# Creating target name list
-names = makeNames(options.bedfile)
-numOfTargets = len(names)
+# Reading targets (names, preceding ends and clusters)
+targets = readTargets(options.bedfile)
+numOfTargets = len(targets)
 
 # Print out info
 printInfo(options, config, numOfTargets)
 
-# Setting sample name
-samplename = options.input[:options.input.rfind('.bam')]
-
-# Defining break points in the input BED file
-breaks = findFileBreaks(options.bedfile, int(options.threads))
-
-# Initializing processes
-threadidx = 0
-processes = []
-for (startline, endline) in breaks:
-    threadidx += 1
-    processes.append(SingleJob(threadidx, options, config, startline, endline, names))
+# Running the analysis in a single process, or in several processes pulling (batch of targets, sample) jobs from a
+# shared queue
+if int(options.threads) == 1 and options.bamlist is None:
+    process = SingleJob(1, options, config, options.input, targets)
+    process.start()
+    process.join()
 
-# Running processes
-for process in processes: process.start()
-for process in processes: process.join()
-
-# Merging tmp files
-if int(options.threads) > 1:
-    mergeTmpFiles(options, config)
-
-# Reading on-target read counts from tmp file
-ontarget = dict()
-for threadidx in range(1, int(options.threads) + 1):
-    for line in open(options.output + '_reads_on_target_' + str(threadidx) + '.txt'):
+    # Reading on-target read counts from tmp file
+    ontarget = dict()
+    for line in open(options.output + '_reads_on_target_1.txt'):
         [key, value] = line.split(':')
-        if key in ontarget.keys():
-            ontarget[key] += int(value.strip())
-        else:
-            ontarget[key] = int(value.strip())
-    os.remove(options.output + '_reads_on_target_' + str(threadidx) + '.txt')
+        ontarget[key] = int(value.strip())
+    os.remove(options.output + '_reads_on_target_1.txt')
+    ontarget = [ontarget]
 
-# Reading number of failed targets from tmp file
-failedtargets = 0
-for threadidx in range(1, int(options.threads) + 1):
-    for line in open(options.output + '_failedtargets_' + str(threadidx) + '.txt'):
+    # Reading number of failed targets from tmp file
+    failedtargets = 0
+    for line in open(options.output + '_failedtargets_1.txt'):
         failedtargets += int(line)
-    os.remove(options.output + '_failedtargets_' + str(threadidx) + '.txt')
+    os.remove(options.output + '_failedtargets_1.txt')
+    failedtargets = [failedtargets]
+
+else:
+    samfile = pysam.Samfile(bams[0], "rb")
+    batches = makeBatches(targets, estimateDepths(samfile, bams[0]), int(options.threads))
+    samfile.close()
+
+    taskqueue = multiprocessing.Queue()
+    resultqueue = multiprocessing.Queue()
+    processes = []
+    for threadidx in range(1, int(options.threads) + 1):
+        processes.append(BatchJob(threadidx, options, config, bams, targets, taskqueue, resultqueue))
+    for process in processes: process.start()
+
+    # Jobs are ordered batch by batch, so that the samples of a batch are processed together
+    jobs = [(batchidx, sampleidx, batches[batchidx][0], batches[batchidx][1]) for batchidx in range(len(batches))
+            for sampleidx in range(len(bams))]
+
+    if options.bamlist is None:
+        failedtargets, ontarget = writeBatchOutput(prefixes, None, None, config, jobs, taskqueue, resultqueue,
+                                                   processes, numOfTargets)
+    else:
+        failedtargets, ontarget = writeBatchOutput(prefixes, samplenames, options.output, config, jobs, taskqueue,
+                                                   resultqueue, processes, numOfTargets)
+    for process in processes: process.join()
 
 # Closing progress info
-if failedtargets > 0:
-    print ' - Done. (' + str(failedtargets) + ' failed regions)'
+if sum(failedtargets) > 0:
+    print ' - Done. (' + str(sum(failedtargets)) + ' failed regions)'
 else:
     print ' - Done.'
 
 # Calculate and output chromosome summary data
-samfile = pysam.Samfile(options.input, "rb")
-chromdata = calculateChromdata(samfile, ontarget)
-output_summary(options, chromdata)
+for i in range(len(bams)):
+    samfile = pysam.Samfile(bams[i], "rb")
+    chromdata = calculateChromdata(samfile, ontarget[i], config)
+    output_summary(prefixes[i], chromdata)
 
 print ""
 print 'CoverView v1.1.1 succesfully finished: ', datetime.datetime.now()
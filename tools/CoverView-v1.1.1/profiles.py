@@ -0,0 +1,399 @@
+from __future__ import division
+import cStringIO
+import zipfile
+import numpy
+
+
+#######################################################################################################################
+
+# Maximum read depth of the pysam pileup engine (bam_plp maxcnt)
+PILEUP_MAX_DEPTH = 8000
+
+# Read flags always skipped by the pileup engine, and skipped when duplicates are excluded (BAM_DEF_MASK)
+FLAG_UNMAPPED = 4
+FLAG_DEFAULT_MASK = 1796
+FLAG_DUPLICATE = 1024
+
+
+# Calculating COV, QCOV, MEDBQ, FLBQ, MEDMQ, FLMQ (and optional BQ/MQ percentile) profiles of region (begin, end] from the
+# CIGAR blocks of the reads, using per-position quality histograms
+# Output is identical to iterating over samfile.pileup(chrom, begin, end + 1): positions not covered by any read are
+# compacted to the end of the profiles, as the pileup engine does not return empty columns. Returns None if the region
+# cannot be reproduced exactly (read depth close to the pileup depth limit or unusual CIGAR strings), in which case the
+# pileup engine has to be used instead.
+def calculateProfiles(samfile, chrom, begin, end, bq_cutoff, mq_cutoff, duplicates, bq_percentiles, mq_percentiles):
+    reads = decodeReads(samfile, chrom, begin, end + 1)
+    return profilesFromReads(reads, begin, end, bq_cutoff, mq_cutoff, duplicates, bq_percentiles, mq_percentiles)
+
+
+# Calculating the profiles of region (begin, end] (as calculateProfiles) from reads decoded by decodeReads
+# The reads must have been decoded from a region containing [begin, end + 1).
+def profilesFromReads(reads, begin, end, bq_cutoff, mq_cutoff, duplicates, bq_percentiles, mq_percentiles):
+    if not reads.exact: return None
+
+    length = end - begin
+    offset = begin + 1
+
+    # Reads returned by samfile.fetch(chrom, begin, end + 1) and not masked out by the pileup engine
+    if duplicates:
+        flagmask = FLAG_UNMAPPED
+    else:
+        flagmask = FLAG_UNMAPPED | FLAG_DEFAULT_MASK
+    selected = reads.overlapping(begin, end + 1) & ((reads.flags & flagmask) == 0) & reads.hascigar
+    if (selected & reads.unsupported).any(): return None
+
+    # Falling back to the pileup engine if the depth limit of the pileup could be reached
+    if 2 * selected.sum() + 2 > PILEUP_MAX_DEPTH:
+        if 2 * maximumDepth(reads.starts[selected], reads.ends[selected]) + 2 > PILEUP_MAX_DEPTH: return None
+
+    # Aligned base blocks of the reads, clipped to the region
+    starts = numpy.maximum(reads.blockstarts, offset)
+    ends = numpy.minimum(reads.blockstarts + reads.blocklengths, end + 1)
+    inregion = selected[reads.blockreads] & (starts < ends)
+    starts = starts[inregion]
+    baselengths = ends[inregion] - starts
+    qualstarts = reads.blockquals[inregion] + starts - reads.blockstarts[inregion]
+
+    # Base and mapping qualities of all aligned bases, in the order of the blocks
+    blockoffsets = numpy.cumsum(baselengths) - baselengths
+    index = numpy.arange(baselengths.sum())
+    bqs = reads.quals[numpy.repeat(qualstarts - blockoffsets, baselengths) + index].astype(numpy.int64) - 33
+    mqs = numpy.repeat(reads.mapqs[reads.blockreads[inregion]], baselengths)
+    positions = numpy.repeat(starts - offset - blockoffsets, baselengths) + index
+
+    # Per-position histograms of base and mapping qualities
+    bqhist = makeQualityHistogram(positions, bqs, length)
+    mqhist = makeQualityHistogram(positions, mqs, length)
+    nbases = bqhist.total()
+
+    # Number of deletions (with high mapping quality) per position
+    delstarts = numpy.maximum(reads.delstarts, offset)
+    delends = numpy.minimum(reads.delends, end + 1)
+    inregion = selected[reads.delreads] & (delstarts < delends)
+    delstarts = delstarts[inregion] - offset
+    delends = delends[inregion] - offset
+    ndels = blockCounts(delstarts, delends, length)
+    goodmq = reads.mapqs[reads.delreads[inregion]] >= mq_cutoff
+    ndels_goodmq = blockCounts(delstarts[goodmq], delends[goodmq], length)
+
+    # Coverage and quality coverage
+    cov = nbases + ndels
+    good = (mqs >= mq_cutoff) & (bqs >= bq_cutoff)
+    qcov = numpy.bincount(positions[good], minlength=length) + ndels_goodmq
+
+    # Compacting profiles to the positions returned by the pileup engine
+    idx = numpy.flatnonzero(cov > 0)
+    padding = length - len(idx)
+    nan = float('NaN')
+
+    ret = dict()
+    ret['COV'] = cov[idx].tolist() + [0] * padding
+    ret['QCOV'] = qcov[idx].tolist() + [0] * padding
+    ret['MEDBQ'] = bqhist.median()[idx].tolist() + [nan] * padding
+    ret['FLBQ'] = roundProfile(bqhist.fractionBelow(bq_cutoff)[idx].tolist()) + [nan] * padding
+    ret['MEDMQ'] = mqhist.median()[idx].tolist() + [nan] * padding
+    ret['FLMQ'] = roundProfile(mqhist.fractionBelow(mq_cutoff)[idx].tolist()) + [nan] * padding
+    for p in bq_percentiles:
+        ret['P' + str(p) + 'BQ'] = bqhist.percentile(p)[idx].tolist() + [nan] * padding
+    for p in mq_percentiles:
+        ret['P' + str(p) + 'MQ'] = mqhist.percentile(p)[idx].tolist() + [nan] * padding
+
+    return ret
+
+
+# Reading the reads returned by samfile.fetch(chrom, begin, end) once, and decoding their flags, mapping qualities, names,
+# base qualities and CIGAR blocks into a ReadBlocks object
+def decodeReads(samfile, chrom, begin, end):
+    ret = ReadBlocks()
+
+    starts = []
+    ends = []
+    flags = []
+    mapqs = []
+    qnames = []
+    hascigar = []
+    unsupported = []
+    quals = []
+    qualoffset = 0
+    blockreads = []
+    blockstarts = []
+    blocklengths = []
+    blockquals = []
+    delreads = []
+    delstarts = []
+    delends = []
+
+    for read in samfile.fetch(chrom, begin, end):
+        i = len(starts)
+        cigar = read.cigar
+        refpos = read.pos
+        bad = False
+
+        if cigar:
+            qual = read.qual
+            if qual is None: qual = ''
+            qpos = 0
+            aligned = False
+
+            for (op, l) in cigar:
+                # Aligned bases (M, =, X)
+                if op == 0 or op == 7 or op == 8:
+                    aligned = True
+                    blockreads.append(i)
+                    blockstarts.append(refpos)
+                    blocklengths.append(l)
+                    blockquals.append(qualoffset + qpos)
+                    if qpos + l > len(qual): bad = True
+                    refpos += l
+                    qpos += l
+
+                # Deletions and reference skips (D, N); reads starting with a reference skip are not handled
+                elif op == 2 or op == 3:
+                    if op == 3 and not aligned: bad = True
+                    aligned = True
+                    delreads.append(i)
+                    delstarts.append(refpos)
+                    delends.append(refpos + l)
+                    refpos += l
+
+                # Insertions and soft clips (I, S)
+                elif op == 1 or op == 4:
+                    qpos += l
+
+                # Back operations change the alignment end used by samfile.fetch, so the reads are not handled
+                elif op == 9:
+                    bad = True
+                    ret.exact = False
+
+            quals.append(qual)
+            qualoffset += len(qual)
+            readend = refpos
+        else:
+            readend = refpos + 1
+
+        starts.append(read.pos)
+        ends.append(readend)
+        flags.append(read.flag)
+        mapqs.append(read.mapq)
+        qnames.append(read.qname)
+        hascigar.append(bool(cigar))
+        unsupported.append(bad)
+
+    ret.starts = numpy.array(starts, dtype=numpy.int64)
+    ret.ends = numpy.array(ends, dtype=numpy.int64)
+    ret.flags = numpy.array(flags, dtype=numpy.int64)
+    ret.mapqs = numpy.array(mapqs, dtype=numpy.int64)
+    ret.qnames = qnames
+    ret.hascigar = numpy.array(hascigar, dtype=bool)
+    ret.unsupported = numpy.array(unsupported, dtype=bool)
+    ret.quals = numpy.fromstring(''.join(quals), dtype=numpy.uint8)
+    ret.blockreads = numpy.array(blockreads, dtype=numpy.int64)
+    ret.blockstarts = numpy.array(blockstarts, dtype=numpy.int64)
+    ret.blocklengths = numpy.array(blocklengths, dtype=numpy.int64)
+    ret.blockquals = numpy.array(blockquals, dtype=numpy.int64)
+    ret.delreads = numpy.array(delreads, dtype=numpy.int64)
+    ret.delstarts = numpy.array(delstarts, dtype=numpy.int64)
+    ret.delends = numpy.array(delends, dtype=numpy.int64)
+    return ret
+
+
+# Rounding fractions to 3 decimals (as Python round does; NaN values are kept)
+def roundProfile(values):
+    return [round(x, 3) if x == x else x for x in values]
+
+
+# Counting the number of blocks [start, end) covering each position
+def blockCounts(starts, ends, length):
+    if len(starts) == 0: return numpy.zeros(length, dtype=numpy.int64)
+    delta = numpy.bincount(starts, minlength=length + 1) - numpy.bincount(ends, minlength=length + 1)
+    return numpy.cumsum(delta)[:length]
+
+
+# Calculating the maximum number of reads overlapping any position
+def maximumDepth(starts, ends):
+    events = numpy.concatenate((numpy.ones(len(starts), dtype=numpy.int64), -numpy.ones(len(ends), dtype=numpy.int64)))
+    coords = numpy.concatenate((numpy.array(starts, dtype=numpy.int64), numpy.array(ends, dtype=numpy.int64)))
+    order = numpy.lexsort((events, coords))
+    return int(numpy.cumsum(events[order]).max())
+
+
+# Creating per-position histograms from quality values observed at the given positions
+def makeQualityHistogram(positions, qualities, length):
+    values, bins = numpy.unique(qualities, return_inverse=True)
+    counts = numpy.bincount(positions * len(values) + bins, minlength=length * len(values))
+    return QualityHistogram(values, counts.reshape((length, len(values))).astype(numpy.int32))
+
+
+#######################################################################################################################
+
+# Class representing the reads of a region decoded by decodeReads, in BAM file order
+# Per-read arrays: starts, ends (alignment end as used by samfile.fetch), flags, mapqs, qnames, hascigar and unsupported
+# (reads whose profiles cannot be calculated from their blocks). Aligned base blocks (blockreads, blockstarts,
+# blocklengths and blockquals, the offset of the block in quals) and deletion blocks (delreads, delstarts, delends) refer
+# to the index of their read. exact is False if the region contains reads whose overlaps cannot be reproduced.
+class ReadBlocks(object):
+    # Constructor
+    def __init__(self):
+        self.exact = True
+
+    # Reads that samfile.fetch(chrom, begin, end) returns
+    def overlapping(self, begin, end):
+        return (self.starts < end) & (self.ends > begin)
+
+    # Position, name and duplicate status of the reads that samfile.fetch(chrom, begin, end) returns, in BAM file order
+    def alignments(self, begin, end):
+        idx = numpy.flatnonzero(self.overlapping(begin, end))
+        duplicates = (self.flags[idx] & FLAG_DUPLICATE) > 0
+        return zip(self.starts[idx].tolist(), [self.qnames[i] for i in idx], duplicates.tolist())
+
+
+#######################################################################################################################
+
+# Class representing histograms of quality values at consecutive positions
+# Only the quality values observed are stored as bins, so histograms of mapping qualities (0-255) remain small.
+class QualityHistogram(object):
+    # Constructor
+    def __init__(self, values, counts):
+        self.values = values
+        self.counts = counts
+
+    # Number of values at each position
+    def total(self):
+        return self.counts.sum(axis=1).astype(numpy.int64)
+
+    # Merging with the histogram of the same positions (e.g. from another shard or sample)
+    def merge(self, other):
+        values = numpy.union1d(self.values, other.values)
+        counts = numpy.zeros((len(self.counts), len(values)), dtype=numpy.int32)
+        counts[:, numpy.searchsorted(values, self.values)] += self.counts
+        counts[:, numpy.searchsorted(values, other.values)] += other.counts
+        return QualityHistogram(values, counts)
+
+    # Fraction of values below cutoff at each position (NaN where there are no values)
+    def fractionBelow(self, cutoff):
+        below = self.counts[:, self.values < cutoff].sum(axis=1)
+        with numpy.errstate(invalid='ignore'):
+            return below / self.total().astype(numpy.float64)
+
+    # Median at each position (NaN where there are no values)
+    def median(self):
+        n = self.total()
+        return (self.valueAtRank((n - 1) // 2) + self.valueAtRank(n // 2)) / 2.0
+
+    # Percentile (0-100) at each position with linear interpolation, as numpy.percentile (NaN where there are no values)
+    def percentile(self, p):
+        n = self.total()
+        index = (n - 1) * (p / 100.0)
+        below = numpy.floor(index).astype(numpy.int64)
+        above = numpy.ceil(index).astype(numpy.int64)
+        weight = index - below
+        return self.valueAtRank(below) * (1 - weight) + self.valueAtRank(above) * weight
+
+    # Value of the given rank (0-based, in increasing order) at each position (NaN where there are no values)
+    def valueAtRank(self, ranks):
+        ret = numpy.empty(len(self.counts))
+        ret.fill(float('NaN'))
+        hasvalues = self.total() > 0
+        if not hasvalues.any(): return ret
+        cumulative = numpy.cumsum(self.counts[hasvalues], axis=1)
+        bins = numpy.argmax(cumulative > ranks[hasvalues][:, numpy.newaxis], axis=1)
+        ret[hasvalues] = self.values[bins]
+        return ret
+
+
+#######################################################################################################################
+
+# Creating the profile array of a target (one row per position, one field per profile), as written to .npz profile files
+def makeProfileArray(profiles, start, columns, transcoords):
+    n = len(profiles['COV'])
+    fields = [('Position', numpy.int64)]
+    if not transcoords is None:
+        fields.append(('Transcript_coordinate', 'S' + str(max([len(x) for x in transcoords] + [1]))))
+    fields.extend([('COV', numpy.int64), ('QCOV', numpy.int64)])
+    fields.extend([(key, numpy.float64) for key in ['MEDBQ', 'FLBQ', 'MEDMQ', 'FLMQ'] + columns])
+
+    ret = numpy.zeros(n, dtype=fields)
+    ret['Position'] = numpy.arange(start, start + n)
+    if not transcoords is None: ret['Transcript_coordinate'] = transcoords
+    for key in ['COV', 'QCOV', 'MEDBQ', 'FLBQ', 'MEDMQ', 'FLMQ'] + columns:
+        ret[key] = profiles[key]
+    return ret
+
+
+# Serializing an array in .npy format
+def serializeArray(array):
+    buf = cStringIO.StringIO()
+    numpy.lib.format.write_array(buf, array)
+    return buf.getvalue()
+
+
+#######################################################################################################################
+
+# Class writing target profiles to an .npz file
+# Each target is stored as a separate array (profile_<i>.npy), written as soon as the target is done, and the targets
+# array lists the name, chromosome, start and end of target i. Records are (name, chrom, start, end, data) tuples with
+# data being a profile array serialized by serializeArray.
+class ProfileWriter(object):
+    # Constructor
+    def __init__(self, filename):
+        self.zipfile = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.targets = []
+
+    # Writing the profile of a target
+    def append(self, record):
+        (name, chrom, start, end, data) = record
+        self.writeMember('profile_' + str(len(self.targets)) + '.npy', data)
+        self.targets.append((name, chrom, start, end))
+
+    # Writing the targets array and closing the file
+    def close(self):
+        namelength = max([len(x[0]) for x in self.targets] + [1])
+        chromlength = max([len(x[1]) for x in self.targets] + [1])
+        fields = [('Name', 'S' + str(namelength)), ('Chrom', 'S' + str(chromlength)), ('Start', numpy.int64),
+                  ('End', numpy.int64)]
+        self.writeMember('targets.npy', serializeArray(numpy.array(self.targets, dtype=fields)))
+        self.zipfile.close()
+
+    # Writing a member of the zip file (with a fixed timestamp, so that identical profiles give identical files)
+    def writeMember(self, name, data):
+        info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self.zipfile.writestr(info, data)
+
+
+# Class reading target profiles from an .npz file written by ProfileWriter
+# Only the profiles of the targets requested are read and decompressed.
+class ProfileReader(object):
+    # Constructor
+    def __init__(self, filename):
+        self.npz = numpy.load(filename)
+        self.targets = self.npz['targets']
+        self.index = dict((self.targets['Name'][i], i) for i in range(len(self.targets)))
+
+    # Names of all targets, in BED order
+    def targetNames(self):
+        return self.targets['Name'].tolist()
+
+    # Profile array of a target (None if there is no profile for the target)
+    def target(self, name):
+        if not name in self.index: return None
+        return self.npz['profile_' + str(self.index[name])]
+
+    # Profile arrays of all targets overlapping the 1-based region [start, end], restricted to positions in the region
+    # Returns a list of (target name, profile array) pairs.
+    def region(self, chrom, start, end):
+        if not chrom.startswith('chr'): chrom = 'chr' + chrom
+        ret = []
+        overlapping = (self.targets['Chrom'] == chrom) & (self.targets['Start'] <= end) & (self.targets['End'] >= start)
+        for i in numpy.flatnonzero(overlapping):
+            profile = self.npz['profile_' + str(i)]
+            inregion = (profile['Position'] >= start) & (profile['Position'] <= end)
+            ret.append((self.targets['Name'][i], profile[inregion]))
+        return ret
+
+    # Closing the file
+    def close(self):
+        self.npz.close()
+
+
+#######################################################################################################################
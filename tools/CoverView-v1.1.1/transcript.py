@@ -192,19 +192,35 @@ def getTranscriptCoordinates(enstdb, chrom, pos):
     transcripts = findTranscripts(enstdb, chrom, pos)
     for enstid, transcript in transcripts.iteritems():
         x, y = transformToCSNCoordinate(pos, transcript)
-        transcoord = 'c.' + str(x)
-        if y != 0:
-            if y > 0:
-                transcoord += '+' + str(y)
-            else:
-                transcoord += str(y)
-        ret[transcript] = transcoord
+        ret[transcript] = makeCSNCoordinateString(x, y)
     return ret
 
 
+# Creating the c. notation of a CSN coordinate
+def makeCSNCoordinateString(x, y):
+    transcoord = 'c.' + str(x)
+    if y != 0:
+        if y > 0:
+            transcoord += '+' + str(y)
+        else:
+            transcoord += str(y)
+    return transcoord
+
+
 def findTranscripts(enstdb, chrom, pos):
     ret = OrderedDict()
 
+    for transcript in fetchTranscripts(enstdb, chrom, pos, pos):
+        if not (transcript.transcriptStart + 1 <= pos <= transcript.transcriptEnd): continue
+        ret[transcript.ENST] = transcript
+
+    return ret
+
+
+# Fetching all transcripts in the database file overlapping the genomic region between start and end (1-based)
+def fetchTranscripts(enstdb, chrom, start, end):
+    ret = []
+
     if chrom in enstdb.contigs:
         goodchrom = chrom
     else:
@@ -216,14 +232,9 @@ def findTranscripts(enstdb, chrom, pos):
             else:
                 return ret
 
-    # Checking both end points of the variant
-    reg = goodchrom + ':' + str(pos) + '-' + str(pos)
-    hits = enstdb.fetch(region=reg)
-
-    for line in hits:
-        transcript = Transcript(line)
-        if not (transcript.transcriptStart + 1 <= pos <= transcript.transcriptEnd): continue
-        ret[transcript.ENST] = transcript
+    reg = goodchrom + ':' + str(start) + '-' + str(end)
+    for line in enstdb.fetch(region=reg):
+        ret.append(Transcript(line))
 
     return ret
 
@@ -276,3 +287,103 @@ def transformToCSNCoordinate(pos, transcript):
         else:
             if pos > transcript.codingStartGenomic: return transcript.codingStartGenomic - pos, 0
             if pos < transcript.codingEndGenomic: return '*' + str(transcript.codingEndGenomic - pos), 0
+
+
+# Transforming all genomic positions between first and last to CSN coordinates in one sweep, with the exons of the
+# transcript in genomic order (same results as calling transformToCSNCoordinate for each position)
+def transformRangeToCSNCoordinates(first, last, transcript):
+    ret = []
+
+    # Exon table in genomic order: first and last base of the exon and sum of preceding exon lengths
+    table = []
+    sumOfExonLengths = -transcript.codingStart + 1
+    for exon in transcript.exons:
+        table.append((exon.start + 1, exon.end, sumOfExonLengths))
+        sumOfExonLengths += exon.length
+    if transcript.strand == -1: table.reverse()
+
+    # Transcripts with unordered or overlapping exons are transformed position by position
+    for i in range(len(table)):
+        if table[i][0] > table[i][1] or (i > 0 and table[i - 1][1] >= table[i][0]):
+            for pos in range(first, last + 1):
+                ret.append(transformToCSNCoordinate(pos, transcript))
+            return ret
+
+    boundaries = dict()
+    k = 0
+    for pos in range(first, last + 1):
+        # Positions within UTR (calculated directly)
+        if transcript.isInUTR(pos):
+            ret.append(transformToCSNCoordinate(pos, transcript))
+            continue
+
+        while k + 1 < len(table) and table[k + 1][0] <= pos: k += 1
+        (exonfirst, exonlast, sumOfExonLengths) = table[k]
+
+        # Positions within exon
+        if exonfirst <= pos <= exonlast:
+            if transcript.strand == 1:
+                ret.append((sumOfExonLengths + pos - exonfirst + 1, 0))
+            else:
+                ret.append((sumOfExonLengths + exonlast - pos + 1, 0))
+
+        # Positions within intron, relative to the closer exon boundary
+        elif pos > exonlast and k + 1 < len(table):
+            left = exonlast
+            right = table[k + 1][0]
+            if transcript.strand == 1:
+                if pos <= (right - left) // 2 + left:
+                    boundary, offset = left, pos - left
+                else:
+                    boundary, offset = right, pos - right
+            else:
+                if pos >= (right - left + 1) // 2 + left:
+                    boundary, offset = right, right - pos
+                else:
+                    boundary, offset = left, left - pos
+            if not boundary in boundaries:
+                boundaries[boundary] = transformToCSNCoordinate(boundary, transcript)[0]
+            ret.append((boundaries[boundary], offset))
+
+        else:
+            ret.append(transformToCSNCoordinate(pos, transcript))
+
+    return ret
+
+
+#######################################################################################################################
+
+# Class providing the transcript coordinates of positions of a genomic region (e.g. a target)
+# Transcripts overlapping the region are fetched from the database once. Coordinates of all positions of the region can
+# be calculated in one sweep (calculate), otherwise they are calculated for each requested position separately.
+class RegionTranscriptCoordinates(object):
+    # Constructor
+    def __init__(self, enstdb, chrom, start, end):
+        self.start = start
+        self.end = end
+        self.transcripts = fetchTranscripts(enstdb, chrom, start, end)
+        self.strings = None
+
+    # Getting the transcript coordinates of a position as geneSymbol:ENST:coordinate strings, separated by commas
+    def coordinateString(self, pos):
+        if not self.strings is None: return self.strings[pos - self.start]
+        coords = OrderedDict()
+        for transcript in self.transcripts:
+            if not (transcript.transcriptStart + 1 <= pos <= transcript.transcriptEnd): continue
+            x, y = transformToCSNCoordinate(pos, transcript)
+            coords[transcript.ENST] = transcript.geneSymbol + ':' + transcript.ENST + ':' + makeCSNCoordinateString(x, y)
+        return ','.join(coords.itervalues())
+
+    # Calculating the transcript coordinates of all positions of the region
+    def calculate(self):
+        if not self.strings is None: return
+        coords = [OrderedDict() for _ in range(self.end - self.start + 1)]
+        for transcript in self.transcripts:
+            first = max(self.start, transcript.transcriptStart + 1)
+            last = min(self.end, transcript.transcriptEnd)
+            if first > last: continue
+            i = first - self.start
+            for (x, y) in transformRangeToCSNCoordinates(first, last, transcript):
+                coords[i][transcript.ENST] = transcript.geneSymbol + ':' + transcript.ENST + ':' + makeCSNCoordinateString(x, y)
+                i += 1
+        self.strings = [','.join(x.itervalues()) for x in coords]
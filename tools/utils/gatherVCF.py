@@ -0,0 +1,12 @@
+# Gather VCF files of region shards (given in coordinate order) into one VCF file
+# Usage: python gatherVCF.py output.vcf shard1.vcf shard2.vcf ...
+# The header is taken from the first shard. The shards are disjoint, so their records are concatenated in order.
+
+import sys
+
+out = open(sys.argv[1], 'w')
+for i in range(2, len(sys.argv)):
+    for line in open(sys.argv[i]):
+        if line.startswith('#') and i > 2: continue
+        out.write(line)
+out.close()